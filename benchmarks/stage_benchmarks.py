@@ -0,0 +1,299 @@
+"""
+Stage-level benchmarks for the update and search pipelines.
+
+Synthetic HPA-like immunofluorescence images of several sizes are pushed through every stage
+of DataUpdatePipeline and DataSearchPipeline separately, against the embedded LocalVectorIndex
+in a temporary directory, so the suite runs offline without Milvus. Latency (p50/p99), throughput and peak
+resident memory (RSS) of every stage are written to a JSON file that later runs can be compared against.
+
+Usage (from the repository root):
+    python -m benchmarks.stage_benchmarks --sizes 512 1024 --repeats 3 --output results.json
+    python -m benchmarks.stage_benchmarks --compare results.json
+"""
+import io
+import os
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import threading
+from datetime import datetime
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+
+from src.data_processing import FeatureExtractor, SuperpixelSegmenter, PCAProcessor
+from src.services import LocalVectorIndex
+from src.utils import crop_image
+
+
+def synthetic_hpa_image(size, seed=0):
+    """
+    Generate an HPA-like image: dark background with blue nuclei, green protein staining and red microtubules.
+    """
+    rng = np.random.default_rng(seed)
+    image = np.zeros((size, size, 3), dtype=np.float32)
+    n_cells = max(4, size * size // 20000)
+    centers = rng.integers(0, size, size=(n_cells, 2))
+
+    # Nuclei (blue) as sparse bright points blurred into blobs
+    nuclei = np.zeros((size, size), dtype=np.float32)
+    nuclei[centers[:, 0], centers[:, 1]] = 1.0
+    image[..., 2] = ndimage.gaussian_filter(nuclei, sigma=size / 80)
+
+    # Protein staining (green) around the nuclei with some texture
+    cytoplasm = np.zeros((size, size), dtype=np.float32)
+    offsets = rng.normal(0, size / 60, size=(n_cells * 20, 2)).astype(int)
+    points = np.clip(np.repeat(centers, 20, axis=0) + offsets, 0, size - 1)
+    cytoplasm[points[:, 0], points[:, 1]] = 1.0
+    image[..., 1] = ndimage.gaussian_filter(cytoplasm, sigma=size / 200)
+
+    # Microtubules (red) as smooth noise
+    image[..., 0] = ndimage.gaussian_filter(rng.random((size, size)).astype(np.float32), sigma=size / 100)
+
+    for channel in range(3):
+        peak = image[..., channel].max()
+        if peak > 0:
+            image[..., channel] /= peak
+    image += rng.normal(0, 0.02, size=image.shape).astype(np.float32)
+    return (np.clip(image, 0, 1) * 255).astype(np.uint8)
+
+
+def current_rss_bytes():
+    """Resident set size of this process, or None where it cannot be read."""
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+class MemorySampler:
+    """
+    Peak resident memory of this process while a block runs, sampled from a background thread.
+    RSS covers every allocation (NumPy, torch, native libraries), not only Python objects; the
+    memory of worker processes is not included. When CUDA is in use, the peak memory allocated
+    by torch on the device is recorded as well.
+    """
+
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.start_bytes = self.peak_bytes = None
+        self.peak_cuda_bytes = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        rss = current_rss_bytes()
+        if rss is not None:
+            self.peak_bytes = max(self.peak_bytes or 0, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._cuda = _cuda_torch()
+        if self._cuda is not None:
+            self._cuda.cuda.reset_peak_memory_stats()
+        self.start_bytes = current_rss_bytes()
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        if self._cuda is not None:
+            self.peak_cuda_bytes = self._cuda.cuda.max_memory_allocated()
+        return False
+
+
+def _cuda_torch():
+    """The torch module if CUDA is in use, else None."""
+    try:
+        import torch
+    except ImportError:
+        return None
+    return torch if torch.cuda.is_available() else None
+
+
+class StageTimer:
+    """
+    Collects latency samples, item counts and peak memory for each stage.
+
+    Peak memory is the highest resident set size (RSS) sampled while the stage ran, over all
+    of its runs, both as an absolute value and as the growth over the RSS at the start of the
+    run. The first run of every stage is a warm-up and is left out of the latency statistics
+    unless it is the only one.
+    """
+
+    def __init__(self):
+        self.samples = {}
+
+    def measure(self, stage, function, *args, items=1, **kwargs):
+        record = self.samples.setdefault(stage, {"warmup": None, "seconds": [], "items": [],
+                                                 "peak_rss_bytes": 0, "peak_rss_growth_bytes": 0, "peak_cuda_bytes": None})
+        warmup = record["warmup"] is None
+        with MemorySampler() as memory:
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+        if memory.peak_bytes is not None:
+            record["peak_rss_bytes"] = max(record["peak_rss_bytes"], memory.peak_bytes)
+            record["peak_rss_growth_bytes"] = max(record["peak_rss_growth_bytes"], memory.peak_bytes - memory.start_bytes)
+        if memory.peak_cuda_bytes is not None:
+            record["peak_cuda_bytes"] = max(record["peak_cuda_bytes"] or 0, memory.peak_cuda_bytes)
+        if warmup:
+            record["warmup"] = (elapsed, items)
+        else:
+            record["seconds"].append(elapsed)
+            record["items"].append(items)
+        return result
+
+    def report(self):
+        report = {}
+        for stage, record in self.samples.items():
+            if record["seconds"]:
+                seconds, items = np.array(record["seconds"]), sum(record["items"])
+            else:
+                seconds, items = np.array([record["warmup"][0]]), record["warmup"][1]
+            report[stage] = {
+                "runs": len(seconds),
+                "items": items,
+                "throughput_per_second": items / seconds.sum() if seconds.sum() else None,
+                "p50_ms": float(np.percentile(seconds, 50) * 1000),
+                "p99_ms": float(np.percentile(seconds, 99) * 1000),
+                "peak_rss_mb": record["peak_rss_bytes"] / 1024 ** 2,
+                "peak_rss_growth_mb": record["peak_rss_growth_bytes"] / 1024 ** 2,
+                "peak_cuda_mb": record["peak_cuda_bytes"] / 1024 ** 2 if record["peak_cuda_bytes"] is not None else None,
+            }
+        return report
+
+
+def run_update_stages(timer, size, repeats, feature_extractor, pca_processor, store, n_segments):
+    """Time every stage of DataUpdatePipeline.update_database on synthetic images."""
+    for repeat in range(repeats):
+        url = f"synthetic://{size}/{repeat}"
+        image = synthetic_hpa_image(size, seed=repeat)
+        encoded = io.BytesIO()
+        Image.fromarray(image).save(encoded, format="PNG")
+
+        decoded = timer.measure(f"update/{size}/decode", lambda: np.array(Image.open(io.BytesIO(encoded.getvalue()))))
+
+        segmenter = SuperpixelSegmenter(n_segments=n_segments)
+        segmenter.image = decoded
+        timer.measure(f"update/{size}/slic", segmenter.perform_slic_segmentation)
+        segments = timer.measure(f"update/{size}/segment_filter", segmenter.save_segments)
+        if not segments:
+            continue
+
+        images = [segment["image"] for segment in segments]
+        features = timer.measure(f"update/{size}/feature_extraction", feature_extractor.extract_features_batch, images, items=len(images))
+        reduced = timer.measure(f"update/{size}/pca", pca_processor.fit_transform, features, items=len(features))
+        centroids = [segment["path"] for segment in segments]
+        bboxes = [segment["bbox"] for segment in segments]
+        areas = [segment["area"] for segment in segments]
+        timer.measure(f"update/{size}/insert", store.insert_segments, reduced, centroids, url,
+                      bboxes=bboxes, areas=areas, items=len(reduced))
+
+
+def run_search_stages(timer, size, repeats, feature_extractor, pca_processor, store, regions, top_k):
+    """Time every stage of DataSearchPipeline.search_batch on synthetic images."""
+    rng = np.random.default_rng(1)
+    for repeat in range(repeats):
+        image = Image.fromarray(synthetic_hpa_image(size, seed=100 + repeat))
+        boundaries = []
+        for _ in range(regions):
+            left, top = rng.integers(0, size // 2, size=2)
+            width, height = rng.integers(size // 16, size // 2, size=2)
+            boundaries.append([int(left), int(top), int(left + width), int(top + height)])
+
+        crops = timer.measure(f"search/{size}/crop", lambda: [crop_image(image, boundary) for boundary in boundaries], items=regions)
+        features = timer.measure(f"search/{size}/feature_extraction", feature_extractor.extract_features_batch, crops, items=regions)
+        reduced = timer.measure(f"search/{size}/pca_transform", pca_processor.transform, features, items=regions)
+        timer.measure(f"search/{size}/vector_search", store.find_by_vectors, reduced, top_k=top_k, items=regions)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, previous):
+    """Print the p50 latency change of every stage present in both runs."""
+    print(f"{'stage':45s} {'p50 before':>12s} {'p50 after':>12s} {'change':>8s}")
+    for stage, result in current["stages"].items():
+        if stage in previous["stages"]:
+            before, after = previous["stages"][stage]["p50_ms"], result["p50_ms"]
+            change = (after - before) / before * 100 if before else float('nan')
+            print(f"{stage:45s} {before:12.2f} {after:12.2f} {change:+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048], help="Synthetic image sizes in pixels")
+    parser.add_argument("--repeats", type=int, default=3, help="Images per size and pipeline")
+    parser.add_argument("--n-segments", type=int, default=300, help="SLIC superpixels per image")
+    parser.add_argument("--regions", type=int, default=8, help="Regions per batch search")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--index-type", default="FLAT", choices=["FLAT", "IVF_FLAT"], help="LocalVectorIndex search mode")
+    parser.add_argument("--backend", default="eager", help="FeatureExtractor backend")
+    parser.add_argument("--precision", default="fp32", help="FeatureExtractor precision")
+    parser.add_argument("--pretrained", action="store_true", help="Load the ImageNet weights (needs network or a cache)")
+    parser.add_argument("--output", default="bench_results.json", help="Where to write the JSON results")
+    parser.add_argument("--compare", help="Previous JSON results to compare against")
+    args = parser.parse_args()
+
+    feature_extractor = FeatureExtractor(backend=args.backend, precision=args.precision, pretrained=args.pretrained)
+    # Fit the PCA up front: synthetic images may hold fewer accepted segments than components
+    pca_processor = PCAProcessor()
+    pca_processor.fit_transform(np.random.default_rng(0).normal(size=(512, 2048)).astype(np.float32))
+    timer = StageTimer()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        store = LocalVectorIndex("benchmark", data_dir=data_dir)
+        for size in args.sizes:
+            run_update_stages(timer, size, args.repeats, feature_extractor, pca_processor, store, args.n_segments)
+        if args.index_type == "IVF_FLAT":
+            store.create_index("IVF_FLAT", nlist=max(1, int(np.sqrt(store.count))))
+        for size in args.sizes:
+            run_search_stages(timer, size, args.repeats, feature_extractor, pca_processor, store, args.regions, args.top_k)
+        store.close_connection()
+
+    results = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "parameters": vars(args),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": timer.report(),
+    }
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    for stage, result in results["stages"].items():
+        print(f"{stage:45s} p50 {result['p50_ms']:9.2f} ms  p99 {result['p99_ms']:9.2f} ms  "
+              f"{result['throughput_per_second'] or 0:9.1f}/s  peak RSS +{result['peak_rss_growth_mb']:8.1f} MB")
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r") as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
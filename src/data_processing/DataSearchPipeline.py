@@ -1,32 +1,80 @@
+import numpy as np
 from ..utils import log_message, download_image, crop_image
 
 class DataSearchPipeline:
-    def __init__(self, db_Handler, feature_extractor, pca_processor):
+    def __init__(self, db_Handler, feature_extractor, pca_processor, query_cache=None):
         log_message('info', 'started data search pipeline')
         self.db_handler = db_Handler
         self.feature_extractor = feature_extractor
         self.pca_processor = pca_processor
+        self.query_cache = query_cache  # Optional QueryCache of reduced query vectors
 
     def search(self, image_url, boundary):
-       
+        # Download, crop and reduce the region unless its vector is cached
+        reduced_features, model_version = self.reduce_regions(image_url, [boundary], return_version=True)
 
-        # Download and crop image
-        image = download_image(image_url=image_url)
-        image = crop_image(image, boundary=boundary)
+        #4. Perform search on database, among the vectors of the same PCA version as the query
+        result = self.db_handler.find_by_vector(reduced_features[0].tolist(), model_version=model_version)
         
-        # Extract the image feature
-        log_message('info', f'feature extraction started {image}')
-        features = self.feature_extractor.extract_features(image)
-       
+        return result.to_dict()
+
+    def reduce_regions(self, image_url, boundaries, return_version=False):
+        """
+        Return the reduced feature vector of every region of the image, in the order of the boundaries.
+        Cached vectors are reused; the image is only downloaded when at least one region is missing.
+        With return_version=True the PCA model version of the vectors is returned as well.
+        """
+        reduced = [None] * len(boundaries)
+        model_version = self.pca_processor.version
+        inference_mode = getattr(self.feature_extractor, "mode", None)
+        if self.query_cache is not None:
+            reduced = [self.query_cache.get(image_url, boundary, model_version, inference_mode) for boundary in boundaries]
+        missing = [i for i, vector in enumerate(reduced) if vector is None]
+        if not missing:
+            log_message('info', 'All %d query vectors served from cache', len(boundaries))
+            return (np.vstack(reduced), model_version) if return_version else np.vstack(reduced)
+
+        # Download the image once and crop every missing region from it
+        image = download_image(image_url=image_url)
+        crops = [crop_image(image, boundary=boundaries[i]) for i in missing]
+
+        # Extract the features of all crops in one batch
+        log_message('info', 'feature extraction started for %d regions', len(crops))
+        features = self.feature_extractor.extract_features_batch(crops)
 
-        # 3. Perform PCA on feature vectors
+        # Perform PCA on feature vectors
         log_message('info', 'Started PCA')
-        reduced_features = self.pca_processor.transform(features)
-        reduced_features = reduced_features.flatten()
-        #4. Perform search on database
-        print(reduced_features)
-        result = self.db_handler.find_by_vector(reduced_features.tolist())
-        
-        return result.to_dict()
-       
-    
\ No newline at end of file
+        reduced_features, projected_version = self.pca_processor.transform(features, return_version=True)
+        if projected_version != model_version and len(missing) < len(boundaries):
+            # The model changed since the cache lookup, so the cached vectors are of another version
+            missing = list(range(len(boundaries)))
+            crops = [crop_image(image, boundary=boundary) for boundary in boundaries]
+            features = self.feature_extractor.extract_features_batch(crops)
+            reduced_features, projected_version = self.pca_processor.transform(features, return_version=True)
+        model_version = projected_version
+
+        for i, vector in zip(missing, reduced_features):
+            reduced[i] = vector
+            if self.query_cache is not None:
+                self.query_cache.put(image_url, boundaries[i], model_version, vector, inference_mode)
+        return (np.vstack(reduced), model_version) if return_version else np.vstack(reduced)
+
+    def search_batch(self, image_url, boundaries, top_k=5):
+        """
+        Search several regions of the same image at once.
+        The image is downloaded once, features for all crops are extracted in a single batch
+        and all reduced vectors are sent to the database in one search call.
+        Returns one list of the top_k matches (with their distance) per boundary.
+        """
+        reduced_features, model_version = self.reduce_regions(image_url, boundaries, return_version=True)
+
+        # Perform a single multi-vector search on the database, among vectors of the query's PCA version
+        results = self.db_handler.find_by_vectors(reduced_features, top_k=top_k, model_version=model_version)
+
+        return [
+            [
+                {"id": segment_id, "distance": distance, **segment.to_dict()}
+                for segment_id, distance, segment in matches
+            ]
+            for matches in results
+        ]
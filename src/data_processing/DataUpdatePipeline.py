@@ -1,58 +1,197 @@
 import numpy as np
 from . import SuperpixelSegmenter, FeatureExtractor, PCAProcessor, ClusteringProcessor
 from ..services import MilvusHandler
-from ..utils import log_message, Segment, WorkItem, download_image
+from .IngestEngine import IngestEngine
+from ..utils import log_message, WorkItem, download_image
 
 
 
 class DataUpdatePipeline:
-    def __init__(self, db_handler, feature_extractor, pca_processor, superpixel_segmenter):
+    def __init__(self, db_handler, feature_extractor, pca_processor, superpixel_segmenter, registry=None,
+                 claim_ttl=3600, claim_wait=600):
         log_message('info', 'started data update pipeline')
         self.db_handler = db_handler
         self.feature_extractor = feature_extractor
         self.pca_processor = pca_processor
         self.segmenter = superpixel_segmenter
+        self.registry = registry  # Optional IngestRegistry making ingests idempotent
+        self.claim_ttl = claim_ttl  # Seconds after which the url claim of a dead worker is given up
+        self.claim_wait = claim_wait  # Seconds to wait for another worker ingesting the same url
 
-    def update_database(self, image_url):
+    def ingest_params(self):
+        """
+        Parameters that determine the vectors of an image; a change re-ingests it.
+        """
+        return {
+            "n_segments": self.segmenter.n_segments,
+            "compactness": self.segmenter.compactness,
+            "sigma": self.segmenter.sigma,
+            "segments_per_megapixel": self.segmenter.segments_per_megapixel,
+            "tile_size": self.segmenter.tile_size,
+            "tile_overlap": self.segmenter.tile_overlap,
+            "crop_segments": self.segmenter.crop_segments,
+            "inference_mode": getattr(self.feature_extractor, "mode", None),
+            "n_components": self.pca_processor.n_components,
+        }
 
+    def current_model_version(self):
+        """
+        PCA version an unchanged image must have been stored with to be skipped.
+        An incremental model changes with every ingest, so its version is not compared.
+        """
+        return None if self.pca_processor.incremental else self.pca_processor.version
+
+    def update_database(self, image_url, progress_callback=None, return_details=False):
+        """
+        Download, segment, embed and store the segments of an image.
+        progress_callback, if given, is called with (stage, percent complete) as the pipeline advances.
+        With return_details=True a dict with the status, whether the image was skipped as unchanged
+        and the number of segments inserted is returned instead of the status alone.
+        """
+        def report(stage, progress):
+            if progress_callback is not None:
+                progress_callback(stage, progress)
 
         # Download image from Human Protein Atlas
+        report('download', 0)
         image = download_image(image_url=image_url)
         image = np.array(image)
-        log_message('info', f'{image=}')
+        log_message('info', 'Image downloaded', image_url=image_url, shape=image.shape)
+
+        content_hash = params = owner = None
+        if self.registry is not None:
+            content_hash = self.registry.content_hash(image)
+            params = self.ingest_params()
+            # Only one worker at a time replaces the vectors of a url
+            owner = self.registry.new_owner()
+            if not self.registry.claim(image_url, owner, ttl=self.claim_ttl, wait=self.claim_wait):
+                raise RuntimeError(f"{image_url} is being ingested by another worker.")
+        try:
+            return self._ingest(image_url, image, content_hash, params, report, return_details)
+        finally:
+            if owner is not None:
+                self.registry.release(image_url, owner)
+
+    def _ingest(self, image_url, image, content_hash, params, report, return_details):
+        """Segment, embed and store a downloaded image, replacing its previous vectors."""
+        # Skip images already ingested from the same content, parameters and model
+        if self.registry is not None:
+            if self.registry.is_current(image_url, content_hash, params, self.current_model_version()):
+                log_message('info', 'Image unchanged since its last ingest, skipping', image_url=image_url)
+                report('skipped', 100)
+                return {"status": True, "skipped": True, "segments": 0} if return_details else True
 
         # 1. Perform superpixel segmentation
         log_message('info', 'segmentation started')
+        report('segmentation', 10)
        
         segments = self.segmenter.segment_and_save(image) 
 
         # 2. Convert superpixels into feature vectors
         log_message('info', 'feature extraction started')
+        report('feature_extraction', 30)
         
 
-        all_features = []
-        paths = []
-
-        # Iterate over all image segments in the directory
-        for segment in segments:
-            path = segment['path']  # segment contains the path as a 2D numpy array
-            image = segment['image']  # Assuming each segment also has a path to the segment image
-            features = self.feature_extractor.extract_features(image)
-            all_features.append(features)
-            paths.append(path)
-
-        all_features = np.vstack(all_features)  # Stack all features into a numpy array
+        # Extract the features of all segments in batches
+        images = [segment['image'] for segment in segments]
+        all_features = self.feature_extractor.extract_features_batch(images)
 
         # 3. Perform PCA on feature vectors
         log_message('info', 'Started PCA')
+        report('dimensionality_reduction', 80)
         
-        reduced_features = self.pca_processor.fit_transform(all_features)
+        reduced_features, model_version = self.pca_processor.fit_transform(all_features, return_version=True)
 
         # Store segments in the database
         log_message('info', 'Started Saving Vectors to Database')
-        for i, reduced_feature in enumerate(reduced_features):
-            segment = Segment(vector=reduced_feature.tolist(), path=paths[i], url=image_url)
-            self.db_handler.insert_segment(segment=segment)
+        report('insert', 90)
+        primary_keys = self.db_handler.insert_segments(
+            vectors=reduced_features,
+            centroids=[segment['path'] for segment in segments],  # segment contains its centroid as the path
+            urls=image_url,
+            model_versions=model_version,
+            bboxes=[segment['bbox'] for segment in segments],
+            areas=[segment['area'] for segment in segments]
+        )
+        if self.registry is not None:
+            # Vectors of previous ingests are replaced: everything but the new vectors is deleted
+            # once they are in, so searches never see the image without vectors
+            new_ids = set(primary_keys)
+            stale_ids = [segment_id for segment_id in self.db_handler.ids_by_url(image_url) if segment_id not in new_ids]
+            if stale_ids:
+                self.db_handler.delete_by_ids(stale_ids)
+                log_message('info', 'Replaced %d stale segments', len(stale_ids), image_url=image_url)
+            self.registry.record(image_url, content_hash, params, model_version, len(segments))
+        report('done', 100)
 
+        if return_details:
+            return {"status": True, "skipped": False, "segments": len(segments)}
         return True
-        
\ No newline at end of file
+
+    def reproject_stale_vectors(self):
+        """
+        Re-project the vectors stored with an older PCA model version into the current one.
+
+        Searches only compare vectors of the query's version, so vectors of an older version
+        are not found until they are re-projected. The vectors of each url are replaced the way
+        an ingest replaces them, under the url's claim; urls another worker is ingesting are
+        left to it. Returns the number of vectors re-projected.
+        """
+        current = self.pca_processor.version
+        reprojected = 0
+        for version in self.db_handler.model_versions():
+            if version >= current:
+                continue  # Current, or newer than this process has loaded yet
+            for image_url in self.db_handler.urls_by_model_version(version):
+                owner = None
+                if self.registry is not None:
+                    owner = self.registry.new_owner()
+                    if not self.registry.claim(image_url, owner, ttl=self.claim_ttl):
+                        continue
+                try:
+                    rows = [(segment_id, segment) for segment_id, segment in self.db_handler.segments_by_url(image_url)
+                            if segment.model_version == version]
+                    if not rows:
+                        continue
+                    try:
+                        vectors = self.pca_processor.reproject([segment.vector for _, segment in rows], version)
+                    except OSError as e:
+                        log_message('warning', 'PCA version %d is gone, its vectors cannot be re-projected: %s', version, e)
+                        break
+                    segments = [segment for _, segment in rows]
+                    self.db_handler.insert_segments(
+                        vectors=vectors,
+                        centroids=[segment.centroid for segment in segments],
+                        urls=image_url,
+                        model_versions=current,
+                        bboxes=[segment.bbox for segment in segments],
+                        areas=[segment.area for segment in segments]
+                    )
+                    self.db_handler.delete_by_ids([segment_id for segment_id, _ in rows])
+                    if self.registry is not None:
+                        self.registry.set_model_version(image_url, current)
+                    reprojected += len(rows)
+                finally:
+                    if owner is not None:
+                        self.registry.release(image_url, owner)
+        if reprojected:
+            log_message('info', 'Re-projected %d vectors into PCA version %d', reprojected, current)
+        return reprojected
+
+    def update_database_many(self, image_urls, progress_callback=None, **engine_options):
+        """
+        Ingest a stream of images with the staged IngestEngine so that downloads, segmentation,
+        feature extraction and inserts of different images overlap.
+        Returns the finished WorkItems; engine_options are passed to IngestEngine.
+        """
+        engine = IngestEngine(
+            db_handler=self.db_handler,
+            feature_extractor=self.feature_extractor,
+            pca_processor=self.pca_processor,
+            superpixel_segmenter=self.segmenter,
+            registry=self.registry,
+            ingest_params=self.ingest_params(),
+            model_version=self.current_model_version,
+            **engine_options
+        )
+        return engine.run(image_urls, progress_callback=progress_callback)
@@ -1,54 +1,343 @@
 import os
-from sklearn.decomposition import PCA
+import re
+import json
+import time
+import shutil
+import threading
+from contextlib import nullcontext
+from sklearn.decomposition import PCA, IncrementalPCA
 import numpy as np
 import pickle
-from ..utils import log_message
+from ..utils import log_message, file_lock, STAGE_SECONDS, timed
+
+
+class PCAProjector:
+    """
+    Lightweight float32 projection onto the principal components of a fitted PCA model.
+
+    The projection is exported as plain NumPy arrays, one directory per model version:
+    `<path>/v<version>/mean.npy` and `<path>/v<version>/components.npy`, with
+    `<path>/current` naming the latest version. Loading memory-maps the arrays, so it
+    needs neither pickle nor scikit-learn and costs next to nothing.
+    """
+
+    def __init__(self, mean, components, version=0):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        self.version = version
+        # Folding the mean into an offset lets transform run as a single matmul
+        self.offset = self.mean @ self.components.T
+
+    @classmethod
+    def from_pca(cls, pca, version=0):
+        """Build a projector from a fitted (Incremental)PCA model."""
+        if getattr(pca, "whiten", False):
+            raise ValueError("Whitened PCA models are not supported by PCAProjector.")
+        return cls(pca.mean_, pca.components_, version=version)
+
+    def transform(self, features):
+        """Project a single feature vector or a batch of them: (x - mean) @ components.T in float32."""
+        features = np.asarray(features, dtype=np.float32)
+        if features.ndim == 1:
+            features = features.reshape(1, -1)
+        return features @ self.components.T - self.offset
+
+    def save(self, path):
+        """Export the projection under `path` and mark its version as the current one."""
+        version_dir = os.path.join(path, f"v{self.version}")
+        os.makedirs(version_dir, exist_ok=True)
+        np.save(os.path.join(version_dir, "mean.npy"), self.mean)
+        np.save(os.path.join(version_dir, "components.npy"), self.components)
+
+        # Switch the current version atomically once the arrays are complete
+        tmp_path = os.path.join(path, "current.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump({"version": self.version}, file)
+        os.replace(tmp_path, os.path.join(path, "current"))
+
+    @classmethod
+    def load(cls, path, version=None, mmap=True):
+        """Load the current (or a given) version of an exported projection."""
+        if version is None:
+            with open(os.path.join(path, "current"), "r") as file:
+                version = json.load(file)["version"]
+        version_dir = os.path.join(path, f"v{version}")
+        mmap_mode = 'r' if mmap else None
+        mean = np.load(os.path.join(version_dir, "mean.npy"), mmap_mode=mmap_mode)
+        components = np.load(os.path.join(version_dir, "components.npy"), mmap_mode=mmap_mode)
+        return cls(mean, components, version=version)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "current"))
+
+    @staticmethod
+    def current_version(path):
+        """Version marked as current under `path`, or None if nothing was exported yet."""
+        try:
+            with open(os.path.join(path, "current"), "r") as file:
+                return json.load(file)["version"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def versions(path):
+        """Versions exported under `path`, oldest first."""
+        if not os.path.isdir(path):
+            return []
+        return sorted(int(name[1:]) for name in os.listdir(path) if re.fullmatch(r"v\d+", name))
+
+    @staticmethod
+    def remove(path, version):
+        shutil.rmtree(os.path.join(path, f"v{version}"), ignore_errors=True)
+
 
 class PCAProcessor:
-    def __init__(self, n_components=128, model_path=None):
+    """
+    PCA reduction of the feature vectors, shared by every process using the same model_path.
+
+    Versions are numbered from what is on disk under a file lock, so the search and ingest
+    processes never write the same version twice, and every process picks up a newer
+    version saved by another one within `reload_interval` seconds. Only the newest
+    `keep_versions` versions are kept on disk, along with any version `referenced_versions`
+    (a callable returning the versions stored vectors still carry) reports as in use.
+
+    Vectors of different versions live in different bases and must not be compared; search
+    filters on the version, and reproject maps stored vectors into the current version.
+    """
+
+    def __init__(self, n_components=128, model_path=None, incremental=False, keep_versions=5, reload_interval=5.0,
+                 referenced_versions=None):
         self.n_components = n_components
-        self.pca = PCA(n_components=n_components)
+        self.incremental = incremental  # Keep updating the model from every ingest batch
+        self.pca = IncrementalPCA(n_components=n_components) if incremental else PCA(n_components=n_components)
         self.is_fitted = False  # Track whether PCA has been fitted
+        self.version = 0  # Incremented every time the model changes, 0 while unfitted
         self.model_path = model_path  # Path to save/load the PCA model
+        self.projection_path = f"{model_path}.projection" if model_path else None  # Pickle-free export of the model
+        self.lock_path = f"{model_path}.lock" if model_path else None  # Serialises fits and saves across processes
+        self.keep_versions = max(keep_versions, 2)  # Saved versions kept on disk, the current one included
+        self.reload_interval = reload_interval  # Seconds between checks for a version saved by another process
+        self.referenced_versions = referenced_versions  # Versions never pruned while vectors still use them
+        self.projector = None  # Fast float32 projection used by transform
+        self._model_loaded = False  # Whether the full scikit-learn model has been loaded
+        self._checked_at = time.monotonic()
+        self._lock = threading.Lock()
 
-        if self.model_path and os.path.exists(self.model_path):
+        if self.projection_path and PCAProjector.exists(self.projection_path):
+            # Only the projection is needed to transform; the full model is loaded lazily when refitting
+            self.projector = PCAProjector.load(self.projection_path)
+            self.version = self.projector.version
+            self.is_fitted = True
+            log_message('info', 'Projection version %d loaded', self.version)
+        elif self.model_path and os.path.exists(self.model_path):
             self.load_model(self.model_path)  # Load model if it exists
             log_message('info', 'Model loaded')
 
-    def fit_transform(self, features):
-        if not self.is_fitted:
-            reduced_features = self.pca.fit_transform(features)
-            explained_variance = np.sum(self.pca.explained_variance_ratio_)
-            log_message('info', f"Explained variance by {self.pca.n_components_} components: {explained_variance:.2f}")
-            self.is_fitted = True  # Mark as fitted after fitting
-            if self.model_path:
-                self.save_model(self.model_path)  # Save model after fitting
-            return reduced_features
-        else:
-            log_message('info', "PCA is already fitted. Using transform instead.")
-            return self.transform(features)
+    @timed(STAGE_SECONDS.labels("pca"))
+    def fit_transform(self, features, return_version=False):
+        """
+        Fit the model on the features (or update it in incremental mode) and project them.
+        With return_version=True the model version used for the projection is returned as well.
+        """
+        with self._lock:
+            if self.incremental or not self.is_fitted:
+                # Fit on top of the latest saved version, with no other process fitting meanwhile
+                with self._model_file_lock():
+                    self._reload_if_newer()
+                    if self.incremental:
+                        self._ensure_model_loaded()
+                    if self.incremental and isinstance(self.pca, IncrementalPCA):
+                        self._partial_fit(features)
+                    elif not self.is_fitted:
+                        self.pca.fit(features)
+                        explained_variance = np.sum(self.pca.explained_variance_ratio_)
+                        log_message('info', "Explained variance by %d components: %.2f", self.pca.n_components_, explained_variance)
+                        self.is_fitted = True  # Mark as fitted after fitting
+                        self._model_loaded = True
+                        self.version = self._next_version()
+                        self.projector = PCAProjector.from_pca(self.pca, version=self.version)
+                        if self.model_path:
+                            self.save_model(self.model_path)  # Save model after fitting
+                    else:
+                        log_message('debug', "PCA is already fitted. Using transform instead.")
+            else:
+                if self._due_for_reload():
+                    self._reload_if_newer()
+                log_message('debug', "PCA is already fitted. Using transform instead.")
+            reduced_features = self._transform(features)
+            return (reduced_features, self.version) if return_version else reduced_features
 
-    def transform(self, features):
+    def _partial_fit(self, features):
+        """
+        Update the incremental model with a new batch of features and save the new version.
+        The first batch must hold at least n_components samples.
+        """
+        if not self.is_fitted and len(features) < self.n_components:
+            raise ValueError(f"The first incremental batch needs at least {self.n_components} samples, got {len(features)}.")
+        self.pca.partial_fit(features)
+        self.is_fitted = True
+        self._model_loaded = True
+        self.version = self._next_version()
+        self.projector = PCAProjector.from_pca(self.pca, version=self.version)
+        explained_variance = np.sum(self.pca.explained_variance_ratio_)
+        log_message('info', "PCA model updated to version %d after %d samples, explained variance %.2f", self.version, self.pca.n_samples_seen_, explained_variance)
+        if self.model_path:
+            self.save_model(self.model_path)
+
+    @timed(STAGE_SECONDS.labels("pca"))
+    def transform(self, features, return_version=False):
+        """
+        Project features with the current model.
+        With return_version=True the model version used for the projection is returned as well.
+        """
+        # The projector is replaced as a whole on refit, so no lock is needed to read it
+        self._refresh()
+        projector = self.projector
+        if projector is None:
+            raise ValueError("PCA has not been fitted yet. Call fit_transform first.")
+        reduced_features = projector.transform(features)
+        return (reduced_features, projector.version) if return_version else reduced_features
+
+    def reproject(self, vectors, from_version):
+        """
+        Map vectors projected with an older saved version into the current version.
+        The vectors are lifted back to feature space through the old basis and projected again,
+        so what the old basis left out stays lost, but the result compares with current queries.
+        Raises OSError if the old version is no longer on disk.
+        """
+        projector = self.projector
+        if projector is None or self.projection_path is None:
+            raise ValueError("PCA has not been fitted and saved yet.")
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if from_version == projector.version:
+            return vectors
+        old = PCAProjector.load(self.projection_path, from_version)
+        matrix = old.components @ projector.components.T
+        offset = old.mean @ projector.components.T - projector.offset
+        return vectors @ matrix + offset
+
+    def _transform(self, features):
         if not self.is_fitted:
             raise ValueError("PCA has not been fitted yet. Call fit_transform first.")
-        return self.pca.transform(features)
+        return self.projector.transform(features)
+
+    def _model_file_lock(self):
+        return file_lock(self.lock_path) if self.lock_path else nullcontext()
+
+    def _next_version(self):
+        """Version number for a new model: above every version this or another process saved."""
+        saved = PCAProjector.versions(self.projection_path) if self.projection_path else []
+        return max([self.version, *saved]) + 1
+
+    def _due_for_reload(self):
+        if self.projection_path is None:
+            return False
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return False
+        self._checked_at = now
+        return True
+
+    def _refresh(self):
+        """Pick up a version saved by another process, checking at most every reload_interval seconds."""
+        if self._due_for_reload() and self._lock.acquire(blocking=False):
+            # A fit in progress will publish its own version, so a busy lock skips the check
+            try:
+                self._reload_if_newer()
+            finally:
+                self._lock.release()
+
+    def _reload_if_newer(self):
+        """Switch to the current saved projection if it is newer than ours. Call with _lock held."""
+        version = PCAProjector.current_version(self.projection_path) if self.projection_path else None
+        if version is None or version <= self.version:
+            return False
+        try:
+            projector = PCAProjector.load(self.projection_path, version)
+        except OSError as e:
+            log_message('warning', 'Could not load projection version %d: %s', version, e)
+            return False
+        self.projector = projector
+        self.version = version
+        self.is_fitted = True
+        self._model_loaded = False  # The full model, if ever needed again, is reloaded from disk
+        log_message('info', 'Projection version %d picked up', version)
+        return True
+
+    def _ensure_model_loaded(self):
+        """Load the full scikit-learn model if only the projection was loaded at startup."""
+        if self.is_fitted and not self._model_loaded and self.model_path and os.path.exists(self.model_path):
+            self.load_model(self.model_path)
 
     def save_model(self, path):
-        """Save the PCA model to the specified path using pickle."""
+        """
+        Save the PCA model and its version to the specified path using pickle.
+        A copy is also kept at `<path>.v<version>` so older projections can be reproduced.
+        """
         # Extract the directory path from the file path
         directory = os.path.dirname(path)
 
         # Check if the directory exists; if not, create it
-        if not os.path.exists(directory):
+        if directory and not os.path.exists(directory):
             os.makedirs(directory)
-            
-        with open(path, 'wb') as file:
-            pickle.dump(self.pca, file)
-        print(f"PCA model saved to {path}")
+
+        state = {"pca": self.pca, "version": self.version}
+        for target in (f"{path}.v{self.version}", path):
+            tmp_path = f"{target}.tmp"
+            with open(tmp_path, 'wb') as file:
+                pickle.dump(state, file)
+            os.replace(tmp_path, target)
+
+        # Export the pickle-free projection next to the model
+        PCAProjector.from_pca(self.pca, version=self.version).save(f"{path}.projection")
+        self._prune_versions(path)
+        log_message('info', 'PCA model version %d saved', self.version, path=path)
+
+    def _prune_versions(self, path):
+        """
+        Remove all but the newest keep_versions saved versions of the model and its projection,
+        except the versions stored vectors still reference.
+        """
+        referenced = set(self.referenced_versions()) if self.referenced_versions is not None else set()
+        directory = os.path.dirname(path) or "."
+        prefix = f"{os.path.basename(path)}.v"
+        pickled = sorted(
+            int(name[len(prefix):]) for name in os.listdir(directory)
+            if name.startswith(prefix) and name[len(prefix):].isdigit()
+        )
+        for version in pickled[:-self.keep_versions]:
+            if version in referenced:
+                continue
+            try:
+                os.remove(f"{path}.v{version}")
+            except OSError:
+                pass
+        projection_path = f"{path}.projection"
+        for version in PCAProjector.versions(projection_path)[:-self.keep_versions]:
+            if version not in referenced:
+                PCAProjector.remove(projection_path, version)
 
     def load_model(self, path):
         """Load the PCA model from the specified path using pickle."""
         with open(path, 'rb') as file:
-            self.pca = pickle.load(file)
+            state = pickle.load(file)
+
+        # Models saved before versioning hold the bare PCA object
+        if isinstance(state, dict):
+            self.pca = state["pca"]
+            self.version = state["version"]
+        else:
+            self.pca = state
+            self.version = 1
         self.is_fitted = True
-        print(f"PCA model loaded from {path}")
+        self._model_loaded = True
+        self.projector = PCAProjector.from_pca(self.pca, version=self.version)
+
+        # Export the projection of models saved before it existed so the next start skips pickle
+        if path == self.model_path and not PCAProjector.exists(self.projection_path):
+            self.projector.save(self.projection_path)
+
+        if self.incremental and not isinstance(self.pca, IncrementalPCA):
+            log_message('warning', 'Loaded PCA model is not incremental; it will stay frozen.', path=path)
+        log_message('info', 'PCA model version %d loaded', self.version, path=path)
@@ -1,17 +1,45 @@
+import copy
+import time
+import contextlib
 import torch
 import torch.nn as nn
 import torchvision.models as models
 import torchvision.transforms as transforms
 from PIL import Image
 import numpy as np
-from ..utils import log_message  # Assuming you have a custom logging utility
+from ..utils import log_message, STAGE_SECONDS, timed  # Assuming you have a custom logging utility
+
+BACKENDS = ('eager', 'torchscript', 'compile')
+PRECISIONS = ('fp32', 'bf16', 'int8-static')
+
 
 class FeatureExtractor:
-    def __init__(self, model_name='resnet50', layer='avgpool'):
+    def __init__(self, model_name='resnet50', layer='avgpool', batch_size=32, backend='eager', precision='fp32',
+                 channels_last=False, calibration_images=None, pretrained=True):
+        """
+        Load the feature extraction model and optionally optimise it for CPU inference.
+
+        backend: 'eager', 'torchscript' (traced and frozen) or 'compile' (torch.compile)
+        precision: 'fp32', 'bf16' (autocast) or 'int8-static' (needs calibration_images)
+        channels_last: run convolutions on channels_last tensors
+        pretrained: load the ImageNet weights; False gives random weights for offline benchmarks
+        The unoptimised fp32 model is kept as `reference_model` so check_drift can compare against it.
+        """
         log_message('info', 'Initializing FeatureExtractor...')
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend}. Available backends are: {BACKENDS}")
+        if precision == 'int8-dynamic':
+            # Dynamic quantization only covers Linear layers, and the feature model has none left
+            raise ValueError("Dynamic int8 quantization would leave the model unchanged; use int8-static.")
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision}. Available precisions are: {PRECISIONS}")
+        self.batch_size = batch_size
+        self.backend = backend
+        self.precision = precision
+        self.channels_last = channels_last
         try:
             # Load the pre-trained model
-            self.model = models.resnet50(weights=models.ResNet50_Weights.DEFAULT)
+            self.model = models.resnet50(weights=models.ResNet50_Weights.DEFAULT if pretrained else None)
 
             # Set model to evaluation mode
             self.model.eval()
@@ -27,10 +55,123 @@ class FeatureExtractor:
                 transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
             ])
             log_message('info', 'Image transformation pipeline set up successfully.')
+
+            # Keep the fp32 eager model as the reference and optimise a copy of it
+            self.reference_model = self.model
+            if (backend, precision, channels_last) != ('eager', 'fp32', False):
+                self.model = self._optimize(copy.deepcopy(self.model), calibration_images)
+                log_message('info', 'Inference mode: %s', self.mode, **self.mode)
         except Exception as e:
-            log_message('error', f'Error during initialization of FeatureExtractor: {str(e)}')
+            log_message('error', 'Error during initialization of FeatureExtractor: %s', e)
             raise e
 
+    @property
+    def mode(self):
+        return {"backend": self.backend, "precision": self.precision, "channels_last": self.channels_last}
+
+    def _inference_context(self):
+        """Context used around every forward pass of the optimised model."""
+        if self.precision == 'bf16':
+            return torch.autocast(device_type='cpu', dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def _prepare_batch(self, batch):
+        if self.channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        return batch
+
+    def _optimize(self, model, calibration_images=None):
+        """Apply the selected precision, memory format and backend to a copy of the model."""
+        model.eval()
+        example = self._prepare_batch(torch.randn(1, 3, 224, 224))
+
+        if self.precision == 'int8-static':
+            if not calibration_images:
+                raise ValueError("Static int8 quantization needs calibration_images.")
+            from torch.ao.quantization import get_default_qconfig_mapping
+            from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+            model = prepare_fx(model, get_default_qconfig_mapping('x86'), (example,))
+            with torch.no_grad():
+                for batch in self._batches(calibration_images):
+                    model(batch)
+            model = convert_fx(model)
+
+        if self.channels_last:
+            model = model.to(memory_format=torch.channels_last)
+
+        if self.precision == 'bf16':
+            # Fall back to fp32 when the CPU cannot run bfloat16 kernels
+            try:
+                with torch.no_grad(), self._inference_context():
+                    model(example)
+            except RuntimeError as e:
+                log_message('warning', 'bfloat16 autocast not supported, using fp32: %s', e)
+                self.precision = 'fp32'
+
+        if self.backend == 'torchscript':
+            with torch.no_grad(), self._inference_context():
+                model = torch.jit.freeze(torch.jit.trace(model, example))
+        elif self.backend == 'compile':
+            model = torch.compile(model)
+        return model
+
+    def _batches(self, images, batch_size=None):
+        """Transform images and yield them as stacked tensors of at most batch_size images."""
+        batch_size = batch_size or self.batch_size
+        for start in range(0, len(images), batch_size):
+            yield self._prepare_batch(torch.stack([
+                self.transform(Image.fromarray(np.uint8(image)))
+                for image in images[start:start + batch_size]
+            ]))
+
+    def _forward(self, batch):
+        """Run a batch through the (optimised) model and return flattened fp32 features."""
+        with torch.no_grad(), self._inference_context():
+            features = self.model(batch)
+        return features.float().reshape(features.size(0), -1).numpy()
+
+    def _reference_forward(self, batch):
+        """Run a batch through the fp32 eager reference model."""
+        with torch.no_grad():
+            features = self.reference_model(batch.contiguous())
+        return features.reshape(features.size(0), -1).numpy()
+
+    def check_drift(self, images, repeats=1):
+        """
+        Compare the embeddings of the optimised model with the fp32 reference model on the given images.
+        Returns the cosine similarity statistics and the time taken by both models.
+        """
+        batches = list(self._batches(images))
+
+        # Warm up both models (compilation, tracing caches, allocator)
+        self._reference_forward(batches[0])
+        self._forward(batches[0])
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            reference = np.vstack([self._reference_forward(batch) for batch in batches])
+        reference_seconds = (time.perf_counter() - start) / repeats
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            optimized = np.vstack([self._forward(batch) for batch in batches])
+        optimized_seconds = (time.perf_counter() - start) / repeats
+
+        cosine = np.sum(reference * optimized, axis=1) / (
+            np.linalg.norm(reference, axis=1) * np.linalg.norm(optimized, axis=1) + 1e-12
+        )
+        return {
+            **self.mode,
+            "images": len(images),
+            "mean_cosine_similarity": float(np.mean(cosine)),
+            "min_cosine_similarity": float(np.min(cosine)),
+            "max_drift": float(1.0 - np.min(cosine)),
+            "reference_seconds": reference_seconds,
+            "optimized_seconds": optimized_seconds,
+            "speedup": reference_seconds / optimized_seconds if optimized_seconds else float('inf'),
+        }
+
+    @timed(STAGE_SECONDS.labels("feature_extraction"))
     def extract_features(self, image):
         try:
 
@@ -38,15 +179,50 @@ class FeatureExtractor:
             image = Image.fromarray(np.uint8(image))
 
             # Apply transformations and log the shape after transformation
-            image = self.transform(image).unsqueeze(0)
+            image = self._prepare_batch(self.transform(image).unsqueeze(0))
 
-            # Extract features and ensure no gradients are computed
-            with torch.no_grad():
-                features = self.model(image)
-            # Flatten the features and log the shape
-            features = features.view(features.size(0), -1).numpy()
+            # Extract features and flatten them
+            return self._forward(image)
+        except Exception as e:
+            log_message('error', 'Error during feature extraction: %s', e)
+            raise e
+
+    @timed(STAGE_SECONDS.labels("feature_extraction"))
+    def extract_features_batch(self, images, batch_size=None):
+        """
+        Extract features for a sequence of images, running them through the model in batches.
+        Returns a numpy array of shape (len(images), feature_dim) in the same order as the input.
+        """
+        batch_size = batch_size or self.batch_size
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer.")
+
+        try:
+            # Extract features for every batch and ensure no gradients are computed
+            all_features = [self._forward(batch) for batch in self._batches(images, batch_size)]
 
-            return features
+            if not all_features:
+                return np.empty((0, 0), dtype=np.float32)
+            return np.vstack(all_features)
         except Exception as e:
-            log_message('error', f'Error during feature extraction: {str(e)}')
+            log_message('error', 'Error during batched feature extraction: %s', e)
             raise e
+
+
+def compare_inference_modes(images, modes, tolerance=0.01, repeats=3, calibration_images=None):
+    """
+    Measure the speed and embedding drift of several FeatureExtractor inference modes.
+
+    modes: a list of keyword dictionaries for FeatureExtractor, e.g. {"backend": "torchscript", "precision": "bf16"}
+    tolerance: maximum accepted drift (1 - minimum cosine similarity against the fp32 reference)
+    Returns the reports sorted from fastest to slowest, each with a `within_tolerance` flag.
+    The fastest mode within tolerance is the recommended one.
+    """
+    reports = []
+    for mode in modes:
+        extractor = FeatureExtractor(calibration_images=calibration_images or images, **mode)
+        report = extractor.check_drift(images, repeats=repeats)
+        report["within_tolerance"] = report["max_drift"] <= tolerance
+        reports.append(report)
+        log_message('info', 'Inference mode %s: %s', mode, report)
+    return sorted(reports, key=lambda report: report["optimized_seconds"])
@@ -1,83 +1,218 @@
 import os
+import time
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
 import xml.etree.ElementTree as ET
 import json
-from ..utils import log_message
+from ..utils import log_message, get_image_cache, IngestRegistry
 
 class ImageDownloader:
-    def __init__(self, protein, output_dir="outputs", processed_proteins_file="processed_proteins.json"):
+    def __init__(self, protein, output_dir="outputs", processed_proteins_file="processed_proteins.json", max_workers=8, retries=3, backoff=1.0, registry=None):
         self.url = f"https://www.proteinatlas.org/search/{protein}?format=xml&download=yes"
         self.output_dir = output_dir
+        self.max_workers = max_workers  # Number of concurrent image downloads
+        self.retries = retries  # Number of retries per image after the first attempt
+        self.backoff = backoff  # Base delay in seconds, doubled after every failed attempt
         self.processed_proteins_file = os.path.join(self.output_dir, processed_proteins_file)
         self.root = None
+        self.protein_name = None
 
         # Ensure the output directory exists
         os.makedirs(self.output_dir, exist_ok=True)
 
-        # Load the list of processed proteins from the JSON file, if it exists
-        self.processed_proteins = self._load_processed_proteins()
+        # Processed proteins are kept in the ingest registry, by default next to the images
+        self.registry = registry or IngestRegistry(os.path.join(self.output_dir, "ingest_registry.sqlite"))
+        self._import_processed_proteins()
 
-    def _load_processed_proteins(self):
+    def _import_processed_proteins(self):
+        """Move the proteins of a legacy JSON list into the registry, once."""
         if os.path.exists(self.processed_proteins_file):
             with open(self.processed_proteins_file, "r") as file:
-                return json.load(file)
-        else:
-            return []
+                for protein_name in json.load(file):
+                    self.registry.mark_protein_processed(protein_name)
+            os.replace(self.processed_proteins_file, f"{self.processed_proteins_file}.imported")
 
     def _save_processed_protein(self, protein_name):
-        if protein_name not in self.processed_proteins:
-            self.processed_proteins.append(protein_name)
-            with open(self.processed_proteins_file, "w") as file:
-                json.dump(self.processed_proteins, file)
+        self.registry.mark_protein_processed(protein_name)
+
+    def _check_response(self, response):
+        """Raise requests.HTTPError unless the search XML was returned."""
+        if response.status_code != 200:
+            log_message('error', 'Failed to retrieve XML data, status code %d', response.status_code, url=self.url)
+            raise requests.HTTPError(f"Failed to retrieve XML data, status code {response.status_code}", response=response)
 
     def fetch_xml_data(self):
+        """Fetch the search XML; raises requests.HTTPError if it could not be retrieved."""
+        self.root = None
         response = requests.get(self.url)
-        if response.status_code == 200:
-            self.root = ET.fromstring(response.content)
-            print("XML data fetched successfully.")
-        else:
-            print(f"Failed to retrieve XML data. Status code: {response.status_code}")
-            self.root = None
-
-    def download_images(self):
+        self._check_response(response)
+        self.root = ET.fromstring(response.content)
+        log_message('info', 'XML data fetched', url=self.url)
+
+    def iter_image_urls(self):
+        """
+        Stream the search XML and yield image URLs as soon as they are parsed.
+        Finished elements are cleared so memory stays flat regardless of the document size.
+        The protein name is stored in `protein_name` as soon as it has been parsed.
+        Raises requests.HTTPError if the search XML could not be retrieved.
+        """
+        self.protein_name = None
+        with requests.get(self.url, stream=True) as response:
+            self._check_response(response)
+            response.raw.decode_content = True
+
+            root = None
+            tags = []  # Tags of the currently open elements
+            for event, elem in ET.iterparse(response.raw, events=("start", "end")):
+                if event == "start":
+                    if root is None:
+                        root = elem
+                    tags.append(elem.tag)
+                    continue
+
+                tags.pop()
+                parent = tags[-1] if tags else None
+                if elem.tag == "name" and parent == "protein" and self.protein_name is None:
+                    self.protein_name = elem.text
+                elif elem.tag == "imageUrl" and parent == "image":
+                    if elem.text is not None and elem.text.startswith('http'):
+                        yield elem.text
+                    else:
+                        log_message('warning', 'Invalid or empty image URL: %s', elem.text)
+                elif elem.tag == "image":
+                    elem.clear()
+                elif len(tags) == 1:
+                    # Drop finished top-level entries from the root
+                    root.clear()
+
+    def download_images(self, streaming=False):
+        """
+        Download every image of the protein.
+        In streaming mode the XML is parsed incrementally and downloads start as soon as
+        the first image URLs arrive, without calling fetch_xml_data first.
+        Returns True once the protein is processed (now or before), False if some images
+        failed or the protein name could not be parsed; the protein is only marked processed
+        on success. Raises requests.HTTPError if the search XML could not be retrieved.
+        """
+        if streaming:
+            return self._download_images_streaming()
+
         if self.root is None:
-            print("No XML data to process.")
-            return
+            log_message('warning', 'No XML data to process')
+            return False
 
         protein_name = self._get_protein_name()
-        if self._is_protein_processed(protein_name):
-            print(f"Protein '{protein_name}' has already been processed. Skipping download.")
-            return
+        if protein_name is not None and self._is_protein_processed(protein_name):
+            log_message('info', 'Protein already processed, skipping download', protein=protein_name)
+            return True
 
+        image_urls = []
         for image_elem in self.root.findall(".//image"):
             image_url_elem = image_elem.find("imageUrl")
             if image_url_elem is not None and image_url_elem.text.startswith('http'):
                 image_url = image_url_elem.text
-                print(f"Image URL: {image_url}")
-
-                self._download_image(image_url)
+                log_message('debug', 'Image URL found', image_url=image_url)
+                image_urls.append(image_url)
             else:
-                print(f"Invalid or empty image URL: {image_url_elem.text if image_url_elem is not None else 'None'}")
+                log_message('warning', 'Invalid or empty image URL: %s', image_url_elem.text if image_url_elem is not None else None)
 
-        # Mark the protein as processed
+        failed = self._download_all(image_urls)
+        return self._finish_protein(protein_name, failed)
+
+    def _finish_protein(self, protein_name, failed):
+        """Mark the protein processed if every image was downloaded and its name is known."""
+        if failed:
+            log_message('error', 'Failed to download %d images, not marking the protein as processed', len(failed), protein=protein_name)
+            return False
+        if protein_name is None:
+            log_message('error', 'No protein name in the search XML, not marking the protein as processed', url=self.url)
+            return False
         self._save_processed_protein(protein_name)
+        return True
+
+    def _download_images_streaming(self):
+        skipped = False
+
+        def image_urls():
+            nonlocal skipped
+            for image_url in self.iter_image_urls():
+                if self.protein_name is not None and self._is_protein_processed(self.protein_name):
+                    skipped = True
+                    return
+                log_message('debug', 'Image URL found', image_url=image_url)
+                yield image_url
+
+        failed = self._download_all(image_urls())
+        if skipped:
+            log_message('info', 'Protein already processed, skipping download', protein=self.protein_name)
+            return True
+        return self._finish_protein(self.protein_name, failed)
+
+    def _download_all(self, image_urls):
+        """
+        Download the given images concurrently on a bounded thread pool.
+        Returns the list of urls that could not be downloaded.
+        """
+        failed = []
+        futures = {}
+        seen = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # Submit downloads as the urls arrive, skipping duplicates
+            for image_url in image_urls:
+                if image_url not in seen:
+                    seen.add(image_url)
+                    futures[executor.submit(self._download_image, image_url)] = image_url
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    log_message('error', 'Failed to download image: %s', e, image_url=futures[future])
+                    failed.append(futures[future])
+        return failed
 
     def _download_image(self, image_url):
-        img_response = requests.get(image_url)
         img_filename = image_url.split("/")[-1]
         img_path = os.path.join(self.output_dir, img_filename)
 
-        with open(img_path, "wb") as img_file:
-            img_file.write(img_response.content)
-        print(f"Downloaded: {img_path}")
+        # Skip files that were already downloaded
+        if os.path.exists(img_path):
+            log_message('debug', 'Already downloaded', path=img_path)
+            return img_path
+
+        tmp_path = f"{img_path}.{threading.get_ident()}.part"
+        for attempt in range(self.retries + 1):
+            try:
+                # Fetch the image through the shared cache so later updates and searches reuse it,
+                # then publish it in the output directory with an atomic rename
+                with get_image_cache().open(image_url) as source, open(tmp_path, "wb") as target:
+                    shutil.copyfileobj(source, target)
+                os.replace(tmp_path, img_path)
+                log_message('debug', 'Downloaded', image_url=image_url, path=img_path)
+                return img_path
+            except (requests.exceptions.RequestException, OSError) as e:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                if attempt == self.retries or self._is_permanent_error(e):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                log_message('warning', 'Download failed (%s), retrying in %.1fs', e, delay, image_url=image_url)
+                time.sleep(delay)
+
+    @staticmethod
+    def _is_permanent_error(error):
+        """Client errors (other than rate limiting) will not succeed on retry."""
+        response = getattr(error, "response", None)
+        return response is not None and 400 <= response.status_code < 500 and response.status_code != 429
 
     def _get_protein_name(self):
         """Extracts the protein name from the XML data."""
         protein_name_elem = self.root.find(".//protein/name")
         if protein_name_elem is not None:
             return protein_name_elem.text
-        return "Unknown_Protein"
+        return None
 
     def _is_protein_processed(self, protein_name):
         """Checks if the protein has already been processed."""
-        return protein_name in self.processed_proteins
+        return self.registry.is_protein_processed(protein_name)
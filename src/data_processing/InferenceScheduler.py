@@ -0,0 +1,140 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+import numpy as np
+from ..utils import log_message, INFERENCE_QUEUE_DEPTH, INFERENCE_BATCH_SIZE
+
+_STOP = object()  # Sentinel telling the scheduler thread to exit
+
+
+class InferenceScheduler:
+    """
+    InferenceScheduler merges feature extraction requests from concurrent callers into micro-batches.
+
+    Callers (e.g. the search tasks of a threaded Celery worker) block in extract_features_batch
+    while a single scheduler thread collects the images of every request arriving within
+    `max_wait` seconds of the first one, up to `max_batch_size` images, runs them through the
+    model in one forward pass and hands each caller its own rows back. One large pass uses the
+    CPU cores far better than several batch-of-1 passes competing for them, and the window
+    bounds the extra latency a lone request pays.
+
+    It exposes the same extract_features_batch as FeatureExtractor, so it can replace it in
+    DataSearchPipeline.
+
+    Attributes:
+    ----------
+    max_batch_size : int
+        Largest number of images in one forward pass. A larger request is run on its own.
+    max_wait : float
+        Seconds to wait for more requests once the first one of a batch arrived.
+    """
+
+    def __init__(self, feature_extractor, max_batch_size=32, max_wait=0.01):
+        self.feature_extractor = feature_extractor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._requests = queue.Queue()
+        self._deferred = None  # Request that did not fit in the previous batch, run first in the next
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.queued_images = 0
+        self.batches = 0
+        self.batched_images = 0
+
+    @property
+    def mode(self):
+        """Inference mode of the wrapped feature extractor."""
+        return getattr(self.feature_extractor, "mode", None)
+
+    def start(self):
+        """Start the scheduler thread; safe to call several times."""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+                self._thread.start()
+
+    def close(self):
+        with self._start_lock:
+            if self._thread is not None:
+                self._requests.put(_STOP)
+                self._thread.join()
+                self._thread = None
+
+    def extract_features_batch(self, images, batch_size=None):
+        """
+        Extract the features of the images as part of a shared micro-batch.
+        Blocks until they are ready and returns an array of shape (len(images), feature_dim).
+        batch_size is accepted for compatibility with FeatureExtractor and ignored.
+        """
+        images = list(images)
+        if not images:
+            return np.empty((0, 0), dtype=np.float32)
+        self.start()
+        future = Future()
+        self._update_queue_depth(len(images))
+        self._requests.put((images, future))
+        return future.result()
+
+    def _update_queue_depth(self, change):
+        with self._stats_lock:
+            self.queued_images += change
+            INFERENCE_QUEUE_DEPTH.set(self.queued_images)
+
+    def _collect(self, first):
+        """Gather the requests that arrive within max_wait of the first one, up to max_batch_size images."""
+        batch = [first]
+        size = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is _STOP or size + len(request[0]) > self.max_batch_size:
+                self._deferred = request  # Keep its place at the head of the next batch
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch, size
+
+    def _run(self):
+        while True:
+            first, self._deferred = self._deferred, None
+            if first is None:
+                first = self._requests.get()
+            if first is _STOP:
+                return
+            batch, size = self._collect(first)
+            self._update_queue_depth(-size)
+
+            images = [image for request_images, _ in batch for image in request_images]
+            try:
+                features = self.feature_extractor.extract_features_batch(images, batch_size=max(size, 1))
+            except Exception as e:
+                log_message('error', 'Micro-batch of %d images failed: %s', size, e)
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            INFERENCE_BATCH_SIZE.observe(size)
+            with self._stats_lock:
+                self.batches += 1
+                self.batched_images += size
+
+            start = 0
+            for request_images, future in batch:
+                future.set_result(features[start:start + len(request_images)])
+                start += len(request_images)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "queue_depth": self.queued_images,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_images / self.batches if self.batches else 0.0,
+            }
@@ -0,0 +1,300 @@
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .SuperpixelSegmenter import SuperpixelSegmenter
+from ..utils import log_message, WorkItem, PipelineLevel, download_image, slic_tile, STAGE_SECONDS
+
+_STOP = object()  # Sentinel telling a stage worker that its input is exhausted
+_SLIC_SECONDS = STAGE_SECONDS.labels("slic")
+
+
+class IngestEngine:
+    """
+    IngestEngine moves WorkItems through the ingest levels with bounded queues between stages.
+
+    Stages and where they run:
+    - Download: a pool of I/O threads
+    - Segmentation: a process pool (SLIC is CPU bound and holds the GIL). The workers only
+      import the lightweight slic_tile and send back the label image; the statistics and
+      segment images are built in this process, so no segment image crosses the process boundary.
+      Images larger than the segmenter's tile_size are split into tiles across the same pool
+    - FeatureExtraction: one thread running batched ResNet inference on the torch thread pool
+    - DimensionalityReduction and Storage: one batching writer that projects each image and
+      flushes rows to the database in large inserts
+
+    Across a stream of images every stage works at the same time, so the network, the CPU
+    cores and the database are kept busy instead of taking turns.
+
+    Attributes:
+    ----------
+    download_threads : int
+        Number of concurrent downloads.
+    segmentation_processes : int
+        Size of the segmentation process pool, 0 to segment in threads of the current process.
+    queue_size : int
+        Capacity of each queue between stages, bounding the number of images held in memory.
+    insert_batch_size : int
+        Number of rows the writer accumulates before inserting them.
+    flush_interval : float
+        Seconds the writer waits for new rows before flushing a partial batch.
+    registry : IngestRegistry or None
+        When given, images whose content, ingest_params and model version are unchanged are
+        skipped after download, and the previous vectors of re-ingested images are replaced.
+        Each url is claimed in the registry from download to storage, so another worker
+        ingesting the same url waits up to `claim_wait` seconds instead of duplicating it.
+    claim_ttl : float
+        Seconds after which the claim of a worker that died is given up.
+    """
+
+    def __init__(self, db_handler, feature_extractor, pca_processor, superpixel_segmenter,
+                 download_threads=4, segmentation_processes=2, queue_size=4,
+                 insert_batch_size=2000, flush_interval=2.0,
+                 registry=None, ingest_params=None, model_version=None, claim_ttl=3600, claim_wait=600):
+        self.db_handler = db_handler
+        self.feature_extractor = feature_extractor
+        self.pca_processor = pca_processor
+        self.segmenter = superpixel_segmenter
+        self.download_threads = download_threads
+        self.segmentation_processes = segmentation_processes
+        self.queue_size = queue_size
+        self.insert_batch_size = insert_batch_size
+        self.flush_interval = flush_interval
+        self.registry = registry
+        self.ingest_params = ingest_params or {}
+        self.model_version = model_version  # Callable giving the model version to compare, or None
+        self.claim_ttl = claim_ttl
+        self.claim_wait = claim_wait
+        self.claim_owner = registry.new_owner() if registry is not None else None
+
+    def _segmenter_params(self):
+        return {
+            "n_segments": self.segmenter.n_segments,
+            "compactness": self.segmenter.compactness,
+            "sigma": self.segmenter.sigma,
+            "segments_per_megapixel": self.segmenter.segments_per_megapixel,
+            "tile_size": self.segmenter.tile_size,
+            "tile_overlap": self.segmenter.tile_overlap,
+            "n_jobs": max(self.segmentation_processes, 1),
+            "crop_segments": self.segmenter.crop_segments,
+        }
+
+    def run(self, image_urls, progress_callback=None):
+        """
+        Ingest every image url and return the finished WorkItems, in completion order.
+        Items that failed have the Failed status and an "error" attribute; unchanged images
+        skipped thanks to the registry are Completed with a "skipped" attribute.
+        progress_callback, if given, is called with each WorkItem once it is finished.
+        """
+        url_queue = queue.Queue()
+        segmentation_queue = queue.Queue(maxsize=self.queue_size)
+        feature_queue = queue.Queue(maxsize=self.queue_size)
+        storage_queue = queue.Queue(maxsize=self.queue_size)
+        finished = []
+        finished_lock = threading.Lock()
+
+        def finish(item):
+            if item.body.pop("claimed", False):
+                self.registry.release(item.get_attribute("image_url"), self.claim_owner)
+            with finished_lock:
+                finished.append(item)
+            if progress_callback is not None:
+                progress_callback(item)
+
+        # A url listed twice would be ingested twice and keep both sets of vectors
+        for image_url in dict.fromkeys(image_urls):
+            url_queue.put(WorkItem(body={"image_url": image_url}))
+
+        executor = None
+        if self.segmentation_processes > 0:
+            executor = ProcessPoolExecutor(
+                max_workers=self.segmentation_processes,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        segmenter_params = self._segmenter_params()
+
+        def download(item):
+            item.update_status(PipelineLevel.DOWNLOAD.value)
+            image = download_image(image_url=item.get_attribute("image_url"))
+            if image is None:
+                raise ValueError("Image could not be downloaded.")
+            image = np.array(image)
+            if self.registry is not None:
+                image_url = item.get_attribute("image_url")
+                content_hash = self.registry.content_hash(image)
+                item.set_attribute("content_hash", content_hash)
+                if not self.registry.claim(image_url, self.claim_owner, ttl=self.claim_ttl, wait=self.claim_wait):
+                    raise RuntimeError("Image is being ingested by another worker.")
+                item.set_attribute("claimed", True)
+                # Checked under the claim, so an ingest that just finished elsewhere is seen
+                model_version = self.model_version() if self.model_version is not None else None
+                if self.registry.is_current(image_url, content_hash, self.ingest_params, model_version):
+                    item.set_attribute("skipped", True)
+                    item.update_status(PipelineLevel.COMPLETED.value)
+                    return False  # Finished, nothing left to do
+            item.set_attribute("image", image)
+
+        def segment(item):
+            item.update_status(PipelineLevel.SEGMENTATION.value)
+            image = item.body.pop("image")
+            # A fresh segmenter per image, so the segmentation threads share no state
+            segmenter = SuperpixelSegmenter(**segmenter_params)
+            with _SLIC_SECONDS.time():
+                if segmenter.is_tiled(image):
+                    # Large images are segmented tile by tile in the shared pool, never whole
+                    segmenter.image = image
+                    try:
+                        segmenter.perform_tiled_segmentation(executor)
+                    finally:
+                        segmenter.close()
+                    labels = segmenter.segments
+                elif executor is not None:
+                    slic_args = (image, segmenter.segments_for_area(*image.shape[:2]), segmenter.compactness, segmenter.sigma)
+                    labels = executor.submit(slic_tile, *slic_args).result()
+                else:
+                    labels = slic_tile(image, segmenter.segments_for_area(*image.shape[:2]), segmenter.compactness, segmenter.sigma)
+            item.set_attribute("segments", segmenter.segments_from_labels(image, labels))
+
+        def extract(item):
+            item.update_status(PipelineLevel.FEATURE_EXTRACTION.value)
+            segments = item.get_attribute("segments")
+            item.set_attribute("features", self.feature_extractor.extract_features_batch([segment["image"] for segment in segments]))
+            item.set_attribute("centroids", [segment["path"] for segment in segments])
+            item.set_attribute("bboxes", [segment["bbox"] for segment in segments])
+            item.set_attribute("areas", [segment["area"] for segment in segments])
+            del item.body["segments"]
+
+        segmentation_workers = max(self.segmentation_processes, 1)
+        stages = [
+            (self._start_stage("download", download, self.download_threads, url_queue, segmentation_queue, finish), segmentation_queue, segmentation_workers),
+            (self._start_stage("segmentation", segment, segmentation_workers, segmentation_queue, feature_queue, finish), feature_queue, 1),
+            (self._start_stage("feature_extraction", extract, 1, feature_queue, storage_queue, finish), storage_queue, 1),
+        ]
+        writer = threading.Thread(target=self._writer, args=(storage_queue, finish), name="ingest-writer", daemon=True)
+        writer.start()
+
+        # Close the stages in order: each one stops its successor once all its workers are done
+        for _ in range(self.download_threads):
+            url_queue.put(_STOP)
+        for workers, next_queue, next_workers in stages:
+            for worker in workers:
+                worker.join()
+            for _ in range(next_workers):
+                next_queue.put(_STOP)
+        writer.join()
+
+        if executor is not None:
+            executor.shutdown()
+        return finished
+
+    def _start_stage(self, name, process, n_workers, in_queue, out_queue, finish):
+        """Start the worker threads of a stage and return them."""
+        def work():
+            while True:
+                item = in_queue.get()
+                if item is _STOP:
+                    return
+                try:
+                    finished_early = process(item) is False
+                except Exception as e:
+                    log_message('error', 'Ingest failed at %s: %s', name, e, image_url=item.get_attribute("image_url"), stage=name)
+                    item.update_status(PipelineLevel.FAILED.value)
+                    item.set_attribute("error", f"{name}: {e}")
+                    item.body.pop("image", None)
+                    item.body.pop("segments", None)
+                    finish(item)
+                    continue
+                if finished_early:
+                    finish(item)
+                    continue
+                out_queue.put(item)
+
+        workers = [threading.Thread(target=work, name=f"ingest-{name}-{i}", daemon=True) for i in range(n_workers)]
+        for worker in workers:
+            worker.start()
+        return workers
+
+    def _writer(self, storage_queue, finish):
+        """
+        Project each image with PCA and insert rows in large batches.
+        A partial batch is flushed when no item arrived for flush_interval seconds, or at the end.
+        """
+        pending_items = []
+        vectors, centroids, bboxes, areas, urls, versions = [], [], [], [], [], []
+
+        def flush():
+            if not pending_items:
+                return
+            try:
+                primary_keys = self.db_handler.insert_segments(
+                    vectors=np.vstack(vectors), centroids=centroids, urls=urls, model_versions=versions,
+                    bboxes=bboxes, areas=areas
+                )
+                start = 0
+                for item in pending_items:
+                    count = item.get_attribute("segment_count")
+                    item.set_attribute("primary_keys", primary_keys[start:start + count])
+                    start += count
+                if self.registry is not None:
+                    for item in pending_items:
+                        # Everything stored for the url but the new vectors is stale, whoever inserted it
+                        image_url = item.get_attribute("image_url")
+                        new_ids = set(item.get_attribute("primary_keys"))
+                        stale_ids = [segment_id for segment_id in self.db_handler.ids_by_url(image_url) if segment_id not in new_ids]
+                        if stale_ids:
+                            self.db_handler.delete_by_ids(stale_ids)
+                        self.registry.record(
+                            item.get_attribute("image_url"), item.get_attribute("content_hash"), self.ingest_params,
+                            item.get_attribute("model_version"), item.get_attribute("segment_count")
+                        )
+                for item in pending_items:
+                    item.update_status(PipelineLevel.COMPLETED.value)
+            except Exception as e:
+                log_message('error', 'Insert of %d rows failed: %s', len(vectors), e, rows=len(vectors))
+                for item in pending_items:
+                    item.update_status(PipelineLevel.FAILED.value)
+                    item.set_attribute("error", f"storage: {e}")
+            for item in pending_items:
+                finish(item)
+            pending_items.clear()
+            vectors.clear()
+            centroids.clear()
+            bboxes.clear()
+            areas.clear()
+            urls.clear()
+            versions.clear()
+
+        while True:
+            try:
+                item = storage_queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                flush()
+                continue
+            if item is _STOP:
+                flush()
+                return
+
+            try:
+                item.update_status(PipelineLevel.DIMENSIONALITY_REDUCTION.value)
+                features = item.body.pop("features")
+                reduced_features, model_version = self.pca_processor.fit_transform(features, return_version=True)
+                image_url = item.get_attribute("image_url")
+                item.update_status(PipelineLevel.STORAGE.value)
+                vectors.append(np.asarray(reduced_features, dtype=np.float32))
+                centroids.extend(item.body.pop("centroids"))
+                bboxes.extend(item.body.pop("bboxes"))
+                areas.extend(item.body.pop("areas"))
+                urls.extend([image_url] * len(reduced_features))
+                versions.extend([model_version] * len(reduced_features))
+                item.set_attribute("segment_count", len(reduced_features))
+                item.set_attribute("model_version", model_version)
+                pending_items.append(item)
+            except Exception as e:
+                log_message('error', 'Ingest failed at dimensionality_reduction: %s', e, image_url=item.get_attribute("image_url"), stage='dimensionality_reduction')
+                item.update_status(PipelineLevel.FAILED.value)
+                item.set_attribute("error", f"dimensionality_reduction: {e}")
+                finish(item)
+
+            if len(urls) >= self.insert_batch_size:
+                flush()
@@ -1,33 +1,201 @@
 import os
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+from scipy import ndimage
 from skimage import io, segmentation, filters, measure, color
 import matplotlib.pyplot as plt
-from ..utils import log_message
+from ..utils import log_message, slic_tile, STAGE_SECONDS, SEGMENTS, timed
+
+_ACCEPTED = SEGMENTS.labels("accepted")
+_REJECTED = SEGMENTS.labels("rejected")
+
 
 class SuperpixelSegmenter:
-    def __init__(self, n_segments=300, compactness=50, sigma=0):
+    def __init__(self, n_segments=300, compactness=50, sigma=0, segments_per_megapixel=None,
+                 tile_size=None, tile_overlap=128, n_jobs=None, crop_segments=True):
         """
         Initialize the SuperpixelSegmenter with the image and segmentation parameters.
+
+        segments_per_megapixel: when set, the number of superpixels scales with the image area instead of n_segments
+        tile_size: when set, images larger than tile_size in either dimension are segmented in overlapping tiles
+        tile_overlap: number of pixels shared by neighbouring tiles, should exceed the size of a superpixel
+        n_jobs: number of processes used to segment tiles in parallel (defaults to the number of cores)
+        crop_segments: crop segment images to their bounding box instead of the full frame, the same way whether tiled or not
         """
         self.n_segments = n_segments
         self.compactness = compactness
         self.sigma = sigma
+        self.segments_per_megapixel = segments_per_megapixel
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.crop_segments = crop_segments
         self.segments = None
         self.output_dir = None
         self.variance_threshold = 0.0001  # Threshold for filtering out low-entropy segments
+        self._executor = None
+
+    def segments_for_area(self, height, width):
+        """
+        Number of superpixels to request for an image (or tile) of the given size.
+        """
+        if self.segments_per_megapixel is None:
+            return self.n_segments
+        return max(1, int(round(height * width / 1e6 * self.segments_per_megapixel)))
 
+    def is_tiled(self, image):
+        return self.tile_size is not None and max(image.shape[:2]) > self.tile_size
+
+    @timed(STAGE_SECONDS.labels("slic"))
     def perform_slic_segmentation(self):
         """
         Perform SLIC superpixel segmentation on the image.
         """
+        if self.is_tiled(self.image):
+            self.perform_tiled_segmentation()
+            return
+
         self.segments = segmentation.slic(
             self.image, 
-            n_segments=self.n_segments, 
+            n_segments=self.segments_for_area(*self.image.shape[:2]), 
             compactness=self.compactness, 
             sigma=self.sigma, 
             start_label=1
         )
 
+    def _get_executor(self):
+        """
+        Return the process pool used for tiles, created once and reused across images.
+        The spawn start method keeps the pool safe to create from threaded Celery workers.
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.n_jobs,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    def close(self):
+        """Shut down the tile process pool."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _tile_starts(self, length):
+        """Start offsets of the tiles along one axis, the last tile ending at the image border."""
+        step = self.tile_size - self.tile_overlap
+        if step <= 0:
+            raise ValueError("tile_size must be larger than tile_overlap.")
+        starts = [0]
+        while starts[-1] + self.tile_size < length:
+            starts.append(starts[-1] + step)
+        return starts
+
+    def _tile_grid(self, height, width):
+        """
+        Split the image into tiles. Returns (window, core) pairs where the window is the
+        region segmented by a tile and the core is the part of the image the tile owns.
+        Cores do not overlap and split every overlap in its middle.
+        """
+        half = self.tile_overlap // 2
+        axes = []
+        for length in (height, width):
+            starts = self._tile_starts(length)
+            axes.append([
+                (
+                    start,
+                    min(start + self.tile_size, length),
+                    0 if i == 0 else start + half,
+                    length if i == len(starts) - 1 else starts[i + 1] + half,
+                )
+                for i, start in enumerate(starts)
+            ])
+
+        tiles = []
+        for top, bottom, core_top, core_bottom in axes[0]:
+            for left, right, core_left, core_right in axes[1]:
+                tiles.append(((top, left, bottom, right), (core_top, core_left, core_bottom, core_right)))
+        return tiles
+
+    def perform_tiled_segmentation(self, executor=None):
+        """
+        Perform SLIC on overlapping tiles in parallel and reconcile the labels at the seams.
+
+        Every tile owns the superpixels whose centroid falls inside its core region, and keeps
+        them whole even where they reach into the overlap with a neighbour, so superpixels are
+        not cut at tile borders. Pixels not covered by any owned superpixel fall back to the
+        label of the tile owning them. Labels are finally renumbered from 1.
+
+        Tiles are merged into one preallocated label image as they complete and then released,
+        with at most twice n_jobs tiles queued or held at once. Fallback labels are written
+        as negative numbers straight away, so a later tile owning the pixel can still claim it.
+
+        executor: process pool to segment the tiles in, instead of the segmenter's own
+        """
+        height, width = self.image.shape[:2]
+        tiles = self._tile_grid(height, width)
+        log_message('info', 'Segmenting %dx%d image in %d tiles', height, width, len(tiles))
+
+        executor = executor or self._get_executor()
+        segments = np.zeros((height, width), dtype=np.int32)
+        pending = deque()
+        offset = 0
+
+        def merge_oldest():
+            nonlocal offset
+            ((top, left, _, _), core), future = pending.popleft()
+            offset = self._merge_tile(segments, future.result(), (top, left), core, offset)
+
+        for tile in tiles:
+            (top, left, bottom, right), _ = tile
+            n_segments = self.segments_for_area(bottom - top, right - left)
+            pending.append((tile, executor.submit(slic_tile, self.image[top:bottom, left:right], n_segments, self.compactness, self.sigma)))
+            if len(pending) >= 2 * self.n_jobs:
+                merge_oldest()
+        while pending:
+            merge_oldest()
+
+        np.abs(segments, out=segments)
+        self.segments, _, _ = segmentation.relabel_sequential(segments)
+
+    @staticmethod
+    def _merge_tile(segments, tile_labels, origin, core, offset):
+        """
+        Merge the labels of one tile into the label image. Returns the offset of the next tile.
+        Owned superpixels replace unassigned (0) and fallback (negative) pixels; the core pixels
+        still unassigned take this tile's labels as negative fallbacks.
+        """
+        top, left = origin
+        bottom, right = top + tile_labels.shape[0], left + tile_labels.shape[1]
+        num_labels = int(tile_labels.max()) + 1
+
+        # Keep the superpixels whose centroid falls in the core of this tile
+        labels = tile_labels.ravel()
+        counts = np.bincount(labels, minlength=num_labels)
+        safe_counts = np.where(counts > 0, counts, 1)
+        rows, cols = np.indices(tile_labels.shape)
+        centroid_rows = np.bincount(labels, weights=rows.ravel(), minlength=num_labels) / safe_counts + top
+        centroid_cols = np.bincount(labels, weights=cols.ravel(), minlength=num_labels) / safe_counts + left
+        del rows, cols
+        owned = (
+            (counts > 0)
+            & (centroid_rows >= core[0]) & (centroid_rows < core[2])
+            & (centroid_cols >= core[1]) & (centroid_cols < core[3])
+        )
+
+        window = segments[top:bottom, left:right]
+        mask = owned[tile_labels] & (window <= 0)
+        window[mask] = tile_labels[mask] + offset
+
+        # Provisional labels for the core pixels no owned superpixel covers (yet)
+        core_window = segments[core[0]:core[2], core[1]:core[3]]
+        core_labels = tile_labels[core[0] - top:core[2] - top, core[1] - left:core[3] - left]
+        holes = core_window == 0
+        core_window[holes] = -(core_labels[holes] + offset)
+        return offset + num_labels
+
     
     def calculate_variance(self, segment_image):
         """
@@ -46,6 +214,71 @@ class SuperpixelSegmenter:
         return coords, mean_coords
         
         
+    def compute_segment_statistics(self, block_size=4 * 1024 * 1024):
+        """
+        Compute per-label statistics for every segment in a single pass over the image.
+        The image is processed in blocks of rows of about block_size pixels to bound memory.
+        Returns a dictionary of arrays indexed by segment label:
+        - count: number of pixels in the segment
+        - variance: variance of the grayscale intensity (NaN for empty labels)
+        - centroid: mean (row, col) coordinates of the segment
+        - bbox: (min_row, min_col, max_row, max_col) bounding box, max exclusive
+        """
+        if self.segments is None:
+            raise ValueError("Segmentation has not been performed yet.")
+
+        height, width = self.segments.shape
+        num_segments = int(self.segments.max()) + 1
+        counts = np.zeros(num_segments, dtype=np.int64)
+        sums = np.zeros(num_segments)
+        squared_deviations = np.zeros(num_segments)
+        row_sums = np.zeros(num_segments)
+        col_sums = np.zeros(num_segments)
+        cols = np.arange(width, dtype=np.float64)
+        block_rows = max(1, block_size // width)
+
+        def blocks():
+            for start in range(0, height, block_rows):
+                labels = self.segments[start:start + block_rows]
+                yield start, labels.shape[0], labels.ravel(), color.rgb2gray(self.image[start:start + labels.shape[0]]).ravel()
+
+        # First pass: pixel count, grayscale sum and coordinate sums per label
+        for start, n_rows, labels, gray_image in blocks():
+            counts += np.bincount(labels, minlength=num_segments)
+            sums += np.bincount(labels, weights=gray_image, minlength=num_segments)
+            row_sums += np.bincount(labels, weights=np.repeat(np.arange(start, start + n_rows, dtype=np.float64), width), minlength=num_segments)
+            col_sums += np.bincount(labels, weights=np.tile(cols, n_rows), minlength=num_segments)
+
+        safe_counts = np.where(counts > 0, counts, 1)
+        means = sums / safe_counts
+
+        # Second pass: variance around the per-label mean, for numerical stability
+        for _, _, labels, gray_image in blocks():
+            squared_deviations += np.bincount(labels, weights=(gray_image - means[labels]) ** 2, minlength=num_segments)
+
+        variances = squared_deviations / safe_counts
+        variances[counts == 0] = np.nan
+        centroids = np.column_stack([row_sums / safe_counts, col_sums / safe_counts])
+        centroids[counts == 0] = np.nan
+
+        # Bounding box per label (find_objects only reports labels from 1)
+        bboxes = np.zeros((num_segments, 4), dtype=np.int64)
+        for i, bbox_slice in enumerate(ndimage.find_objects(self.segments), start=1):
+            if bbox_slice is not None:
+                bboxes[i] = (bbox_slice[0].start, bbox_slice[1].start, bbox_slice[0].stop, bbox_slice[1].stop)
+        if counts[0] > 0:
+            background = self.segments == 0
+            rows = np.flatnonzero(background.any(axis=1))
+            columns = np.flatnonzero(background.any(axis=0))
+            bboxes[0] = (rows[0], columns[0], rows[-1] + 1, columns[-1] + 1)
+
+        return {
+            "count": counts,
+            "variance": variances,
+            "centroid": centroids,
+            "bbox": bboxes,
+        }
+
     def save_segments(self):
         """
         Save each segment as an individual image in the output directory, filtering out low-variance segments.
@@ -54,44 +287,55 @@ class SuperpixelSegmenter:
         """
         if self.segments is None:
             raise ValueError("Segmentation has not been performed yet.")
-        
-        num_segments = np.max(self.segments) + 1
-        self.segment_status = np.zeros(num_segments, dtype=bool)  # Track which segments are accepted
+
+        # Compute the statistics of all segments in one step
+        self.segment_stats = self.compute_segment_statistics()
+        num_segments = len(self.segment_stats["count"])
         segments_info = []  # List to store path and file path of each segment
 
-        # Create a mask for each segment and compute variance for all segments in one step
-        variances = np.array([
-            self.calculate_variance(self.image[self.segments == i])
-            for i in range(num_segments)
-        ])
-        
-        # Determine which segments pass the variance threshold
-        accepted_segments = variances > self.variance_threshold
+        # Determine which segments pass the variance threshold (empty labels have NaN variance and are rejected)
+        with np.errstate(invalid='ignore'):
+            accepted_segments = self.segment_stats["variance"] > self.variance_threshold
         self.segment_status = accepted_segments  # Mark accepted/rejected segments
 
+        # Segments are cropped (or not) the same way for tiled and untiled images, so their embeddings compare
+        crop_segments = self.crop_segments
+
         # Now process only the accepted segments
-        for i in range(num_segments):
-            if accepted_segments[i]:
-                mask = self.segments == i
-
-                # Create a white image background
-                segment_image = np.ones_like(self.image) * 255
-                
-                # Copy the segment to the white image
-                segment_image[mask] = self.image[mask]
-
-                # Extract the segment path (coordinates) and add the info to the list
-                segment_path, mean_coords = self.extract_segment_path(mask)
-                segments_info.append({
-                    "path": mean_coords,
-                    "image": segment_image
-                })
-                log_message('info', f'segment {i}/{num_segments} passed')
+        for i in np.flatnonzero(accepted_segments):
+            min_row, min_col, max_row, max_col = self.segment_stats["bbox"][i]
+            window = (slice(min_row, max_row), slice(min_col, max_col))
+            mask = self.segments[window] == i
+
+            # Create a white image background and copy the segment into it
+            if crop_segments:
+                segment_image = np.full_like(self.image[window], 255)
+                segment_image[mask] = self.image[window][mask]
             else:
-                log_message('info', f'segment {i}/{num_segments} rejected')
+                segment_image = np.full_like(self.image, 255)
+                segment_image[window][mask] = self.image[window][mask]
+
+            segments_info.append({
+                "path": self.segment_stats["centroid"][i],
+                "image": segment_image,
+                "bbox": self.segment_stats["bbox"][i],
+                "area": int(self.segment_stats["count"][i]),
+            })
 
+        _ACCEPTED.inc(len(segments_info))
+        _REJECTED.inc(num_segments - len(segments_info))
+        log_message('info', '%d/%d segments passed', len(segments_info), num_segments)
         return segments_info
     
+    def segments_from_labels(self, image, labels):
+        """
+        Filter and save the segments of an image segmented elsewhere (e.g. in a worker process).
+        Returns the same list of dictionaries as segment_and_save.
+        """
+        self.image = image
+        self.segments = labels
+        return self.save_segments()
+
     def segment_and_save(self, image):
         """
         Perform the full process: segment the image and save each segment.
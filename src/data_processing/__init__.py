@@ -1,7 +1,9 @@
 from .Clustering import ClusteringProcessor
 from .DimensionalityReduction import PCAProcessor
-from .FeatureExtraction import FeatureExtractor
+from .FeatureExtraction import FeatureExtractor, compare_inference_modes
 from .ImageDownloader import ImageDownloader
 from .SuperpixelSegmenter import SuperpixelSegmenter
+from .IngestEngine import IngestEngine
+from .InferenceScheduler import InferenceScheduler
 from .DataUpdatePipeline import DataUpdatePipeline
 from .DataSearchPipeline import DataSearchPipeline
\ No newline at end of file
@@ -1 +1,15 @@
 from .database import MilvusHandler
+from .local_index import LocalVectorIndex
+from .broadcast import StatusBroadcaster, Subscription
+
+
+def create_vector_store(backend, collection_name, **options):
+    """
+    Create the vector store selected by `backend`: "milvus" for a Milvus server or
+    "local" for the embedded LocalVectorIndex. Both share the same interface.
+    """
+    if backend == "milvus":
+        return MilvusHandler(collection_name=collection_name, **options)
+    if backend == "local":
+        return LocalVectorIndex(collection_name=collection_name, **options)
+    raise ValueError(f"Unknown vector store backend {backend!r}, expected 'milvus' or 'local'.")
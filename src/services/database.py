@@ -1,13 +1,20 @@
+import json
+import base64
+import numpy as np
 from pymilvus import (
-    connections, FieldSchema, CollectionSchema, DataType, Collection, list_collections
+    connections, FieldSchema, CollectionSchema, DataType, Collection, list_collections, utility
 )
-from ..utils import Segment, log_message
+from ..utils import Segment, GEOMETRY_FIELDS, log_message, STAGE_SECONDS, timed
+
+_SEARCH_SECONDS = STAGE_SECONDS.labels("milvus_search")
+_INSERT_SECONDS = STAGE_SECONDS.labels("milvus_insert")
 
 class MilvusHandler:
-    def __init__(self, collection_name, host="milvus-standalone", port="19530"):
+    def __init__(self, collection_name, host="milvus-standalone", port="19530", insert_batch_size=1000):
         self.collection_name = collection_name
         self.host = host
         self.port = port
+        self.insert_batch_size = insert_batch_size
         self.connect()
         self.create_collection()
 
@@ -18,31 +25,127 @@ class MilvusHandler:
         else:
             log_message('info', 'Already connected to Milvus.')
             
-    def create_collection(self):
+    @staticmethod
+    def _schema():
         """
-        Create a collection in Milvus with a vector field (128 dimensions) and a BSON string field.
+        Schema of a segment collection: the 128-dim vector, its url and PCA model version,
+        and the segment geometry as typed scalar fields that can be filtered on.
         """
-        # Define the fields for the collection
         fields = [
             FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=True),  # Auto-incrementing ID
             FieldSchema(name="vector", dtype=DataType.FLOAT_VECTOR, dim=128),  # 128-dimensional vector
-            FieldSchema(name="path", dtype=DataType.VARCHAR, max_length=1024),  # BSON data stored as VARCHAR
-            FieldSchema(name="url", dtype=DataType.VARCHAR, max_length=256)
+            FieldSchema(name="url", dtype=DataType.VARCHAR, max_length=256),
+            FieldSchema(name="model_version", dtype=DataType.INT64),  # Version of the PCA model used for the vector
+            FieldSchema(name="centroid_row", dtype=DataType.FLOAT),
+            FieldSchema(name="centroid_col", dtype=DataType.FLOAT),
+            FieldSchema(name="bbox_min_row", dtype=DataType.INT32),
+            FieldSchema(name="bbox_min_col", dtype=DataType.INT32),
+            FieldSchema(name="bbox_max_row", dtype=DataType.INT32),  # Exclusive
+            FieldSchema(name="bbox_max_col", dtype=DataType.INT32),  # Exclusive
+            FieldSchema(name="area", dtype=DataType.INT64)  # Pixel count
         ]
+        return CollectionSchema(fields, description="Collection for segment vectors and geometry")
 
-        schema = CollectionSchema(fields, description="Collection for vectors and BSON data")
-        
+    def create_collection(self):
+        """
+        Create a collection in Milvus with a vector field (128 dimensions) and the segment geometry fields.
+        """
         # Create the collection (if not exists)
         if self.collection_name not in list_collections():
-            self.collection = Collection(name=self.collection_name, schema=schema)
+            self.collection = Collection(name=self.collection_name, schema=self._schema())
             self.create_index()
-            log_message('info', f'Collection {self.collection_name} created.')
+            log_message('info', 'Collection %s created.', self.collection_name, collection=self.collection_name)
         else:
             self.collection = Collection(self.collection_name)
-            log_message('info', f'Collection {self.collection_name} already exists.')
+            log_message('info', 'Collection %s already exists.', self.collection_name, collection=self.collection_name)
         
         
+        self._detect_schema()
+        self.collection.load()
+
+    def _detect_schema(self):
+        """Detect which optional fields the collection has; older collections lack some of them."""
+        field_names = {field.name for field in self.collection.schema.fields}
+        # Collections created before vectors were tagged with a model version lack the field
+        self.has_model_version = "model_version" in field_names
+        if not self.has_model_version:
+            log_message('warning', 'Collection %s has no model_version field; versions will not be stored.', self.collection_name, collection=self.collection_name)
+        # Collections created before geometry fields store the centroid as a base64 "path" string
+        self.has_geometry = "centroid_row" in field_names
+        if not self.has_geometry:
+            log_message('warning', 'Collection %s stores base64 paths; run migrate_schema() to move to geometry fields.', self.collection_name, collection=self.collection_name)
+
+        self.output_fields = ["vector", "url"]
+        if self.has_model_version:
+            self.output_fields.append("model_version")
+        self.output_fields.extend(GEOMETRY_FIELDS if self.has_geometry else ["path"])
+
+    @staticmethod
+    def _encode_path(centroid):
+        """Encode a centroid the way collections without geometry fields store it."""
+        return base64.b64encode(np.asarray(centroid, dtype=np.float64).tobytes()).decode('utf-8')
+
+    def _columns(self, vectors, centroids, urls, model_versions, bboxes, areas):
+        """Build the insert columns in the field order of the collection."""
+        data = [vectors, urls]
+        if self.has_model_version:
+            data.append(model_versions)
+        if self.has_geometry:
+            centroids = np.asarray(centroids, dtype=np.float32).reshape(-1, 2)
+            bboxes = np.asarray(bboxes, dtype=np.int32).reshape(-1, 4)
+            data.extend([centroids[:, 0].tolist(), centroids[:, 1].tolist()])
+            data.extend(bboxes[:, column].tolist() for column in range(4))
+            data.append([int(area) for area in areas])
+        else:
+            # Legacy schema: vector, path, url[, model_version]
+            data.insert(1, [self._encode_path(centroid) for centroid in centroids])
+        return data
+
+    def migrate_schema(self, batch_size=1000):
+        """
+        Move a collection that stores base64 paths to the geometry schema.
+
+        Rows are copied in batches into a new collection with the centroid decoded into scalar
+        fields (bounding box and area are unknown for old rows and stored as -1 and 0), then the
+        old collection is dropped and the new one takes its name. Rows get new primary keys.
+        Stop writers before migrating.
+        """
+        if self.has_geometry:
+            log_message('info', 'Collection %s already has geometry fields.', self.collection_name, collection=self.collection_name)
+            return 0
+
+        migrated_name = f"{self.collection_name}_geometry"
+        if migrated_name in list_collections():
+            utility.drop_collection(migrated_name)  # Leftover of an interrupted migration
+        migrated = Collection(name=migrated_name, schema=self._schema())
+
+        copied = 0
+        output_fields = ["vector", "path", "url"] + (["model_version"] if self.has_model_version else [])
+        iterator = self.collection.query_iterator(batch_size=batch_size, expr="id >= 0", output_fields=output_fields)
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            segments = [Segment.from_dict(row) for row in rows]
+            migrated.insert([
+                [row["vector"] for row in rows],
+                [row["url"] for row in rows],
+                [segment.model_version for segment in segments],
+                *([segment.to_row()[field] for segment in segments] for field in GEOMETRY_FIELDS)
+            ])
+            copied += len(rows)
+        iterator.close()
+        migrated.flush()
+
+        self.collection.release()
+        utility.drop_collection(self.collection_name)
+        utility.rename_collection(migrated_name, self.collection_name)
+        self.collection = Collection(self.collection_name)
+        self.create_index()
+        self._detect_schema()
         self.collection.load()
+        log_message('info', 'Migrated %d rows of %s to geometry fields.', copied, self.collection_name, collection=self.collection_name, rows=copied)
+        return copied
 
     def create_index(self, index_type="IVF_FLAT", metric_type="L2", nlist=128):
         """
@@ -60,58 +163,118 @@ class MilvusHandler:
         }
         # Create index on the "vector" field
         self.collection.create_index("vector", index_params)
-        log_message('info', f'Index {index_type} created on the vector field.')
+        log_message('info', 'Index %s created on the vector field.', index_type, collection=self.collection_name, index_type=index_type)
 
+    @timed(_INSERT_SECONDS)
     def insert_segment(self, segment):
         """
         Insert a Segment object into the Milvus collection.
         """
-        vector = segment.vector  # The vector (128-dim float list)
-        path = segment.path  # The BSON data stored as a string
-        url = segment.url
-        # Insert data into Milvus
-        data = [
-            [vector],  # Vectors should be in a nested list (even if inserting one vector)
-            [path],
-            [url]
-        ]
+        # Columns hold one value each (vectors in a nested list even for a single one)
+        data = self._columns([segment.vector], [segment.centroid], [segment.url], [segment.model_version],
+                             [segment.bbox], [segment.area])
         result = self.collection.insert(data)
-        log_message('info', f'Segment with vector inserted into Milvus.')
+        log_message('info', 'Segment with vector inserted into Milvus.')
         return result.primary_keys
 
+    @timed(_INSERT_SECONDS)
+    def insert_segments(self, vectors, centroids, urls, model_versions=0, bboxes=None, areas=None, batch_size=None):
+        """
+        Insert a batch of segments into the Milvus collection using column-wise chunks.
+
+        Parameters:
+        vectors: A sequence of 128-dim vectors or a numpy matrix of shape (n, 128)
+        centroids: A sequence of (row, col) segment centroids, one per vector
+        urls: A sequence of urls, one per vector, or a single url shared by all vectors
+        model_versions: A sequence of PCA model versions, one per vector, or a single version shared by all vectors
+        bboxes: A sequence of (min_row, min_col, max_row, max_col) bounding boxes, -1s when omitted
+        areas: A sequence of segment pixel areas, 0 when omitted
+        batch_size: Number of rows sent per insert call (defaults to insert_batch_size)
+
+        Returns the primary keys of all inserted rows in insertion order.
+        """
+        batch_size = batch_size or self.insert_batch_size
+        if batch_size < 1:
+            raise ValueError("batch_size must be a positive integer.")
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2:
+            raise ValueError("Vectors must be a 2D array of shape (n, dim).")
+        centroids = list(centroids)
+        urls = [urls] * len(vectors) if isinstance(urls, str) else list(urls)
+        model_versions = [int(model_versions)] * len(vectors) if np.isscalar(model_versions) else list(model_versions)
+        bboxes = list(bboxes) if bboxes is not None else [(-1, -1, -1, -1)] * len(vectors)
+        areas = list(areas) if areas is not None else [0] * len(vectors)
+        if not len(vectors) == len(centroids) == len(urls) == len(model_versions) == len(bboxes) == len(areas):
+            raise ValueError("Vectors, centroids, urls, model versions, bboxes and areas must have the same length.")
+
+        primary_keys = []
+        for start in range(0, len(vectors), batch_size):
+            end = start + batch_size
+            data = self._columns(vectors[start:end].tolist(), centroids[start:end], urls[start:end],
+                                 model_versions[start:end], bboxes[start:end], areas[start:end])
+            result = self.collection.insert(data)
+            primary_keys.extend(result.primary_keys)
+
+        log_message('info', '%d segments inserted into Milvus.', len(primary_keys))
+        return primary_keys
+
     def get_segments(self):
         """
         Retrieve all segments in the collection (returning as Segment objects).
         """
-        # Query all vectors and BSON fields
-        results = self.collection.query(expr="id >= 0", output_fields=["vector", "path"])
-        segments = []
-        for result in results:
-            segment = Segment.from_dict({"vector": result['vector'], "path": result['path']})
-            segments.append(segment)
-        
-        return segments
+        # Query all vectors and their geometry
+        results = self.collection.query(expr="id >= 0", output_fields=self.output_fields)
+        return [Segment.from_dict(result) for result in results]
 
-    def find_by_vector(self, vector, top_k=1):
+    def _version_expr(self, model_version):
+        """Filter on the PCA model version, when one is given and the collection stores it."""
+        if model_version is None or not self.has_model_version:
+            return None
+        return f"model_version == {int(model_version)}"
+
+    @timed(_SEARCH_SECONDS)
+    def find_by_vector(self, vector, top_k=1, model_version=None):
         """
         Search for a segment by vector similarity (using L2 distance by default).
+        With model_version, only vectors projected with that PCA model version are compared.
         """
         # Search for top_k most similar vectors
         search_params = {"metric_type": "L2", "params": {"nprobe": 10}}
-        results = self.collection.search([vector], "vector", param=search_params, limit=top_k, output_fields=["vector", "path", "url"])
+        results = self.collection.search([vector], "vector", param=search_params, limit=top_k,
+                                         expr=self._version_expr(model_version), output_fields=self.output_fields)
         
-        if results:
-            # Assuming the search returns BSON fields with the vector
-            segment_dict = {"vector":results[0][0].entity.get("vector"), "path":results[0][0].entity.get("path"), "url":results[0][0].entity.get("url")}
-            segment = Segment.from_dict(segment_dict)
-            return segment
+        if results and results[0]:
+            return self._hit_segment(results[0][0])
         return None
 
+    def _hit_segment(self, hit):
+        return Segment.from_dict({field: hit.entity.get(field) for field in self.output_fields})
+
+    @timed(_SEARCH_SECONDS)
+    def find_by_vectors(self, vectors, top_k=5, nprobe=10, model_version=None):
+        """
+        Search for the top_k most similar segments of several vectors in a single search call.
+        With model_version, only vectors projected with that PCA model version are compared.
+
+        Returns one list per query vector, each containing (id, distance, Segment) tuples
+        ordered from the closest to the furthest hit.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return []
+
+        search_params = {"metric_type": "L2", "params": {"nprobe": nprobe}}
+        results = self.collection.search(vectors.tolist(), "vector", param=search_params, limit=top_k,
+                                         expr=self._version_expr(model_version), output_fields=self.output_fields)
+
+        return [[(hit.id, hit.distance, self._hit_segment(hit)) for hit in hits] for hits in results]
+
     def find_by_id(self, segment_id):
         """
         Find a Segment by its _id (Milvus's auto-incrementing ID).
         """
-        result = self.collection.query(expr=f"id == {segment_id}", output_fields=["vector", "path"])
+        result = self.collection.query(expr=f"id == {segment_id}", output_fields=self.output_fields)
         if result:
             return Segment.from_dict(result[0])  # Assuming from_dict handles the dict format
         return None
@@ -123,15 +286,71 @@ class MilvusHandler:
         if not new_segment:
             raise ValueError("No fields to update provided.")
 
-        update_data = {
-            "vector": new_segment.vector,
-            "path": new_segment.path
-        }
+        update_data = {"vector": new_segment.vector}
+        if self.has_geometry:
+            update_data.update(new_segment.to_row())
+        else:
+            update_data["path"] = self._encode_path(new_segment.centroid)
 
         result = self.collection.update([segment_id], update_data)
-        log_message('info', f'Segment with ID {segment_id} updated.')
+        log_message('info', 'Segment with ID %s updated.', segment_id, segment_id=segment_id)
         return result
 
+    def ids_by_url(self, url):
+        """
+        Return the primary keys of every segment of an image url.
+        """
+        # Strong consistency, so rows inserted just before by any worker are seen
+        results = self.collection.query(expr=f"url == {json.dumps(url)}", output_fields=["id"], consistency_level="Strong")
+        return [result["id"] for result in results]
+
+    def segments_by_url(self, url):
+        """
+        Return (id, Segment) pairs of every segment of an image url.
+        """
+        results = self.collection.query(expr=f"url == {json.dumps(url)}", output_fields=["id"] + self.output_fields,
+                                        consistency_level="Strong")
+        return [(result["id"], Segment.from_dict(result)) for result in results]
+
+    def _scan(self, expr, output_fields, batch_size=None):
+        """Yield the rows matching expr, in batches, without loading the whole collection at once."""
+        iterator = self.collection.query_iterator(batch_size=batch_size or self.insert_batch_size, expr=expr, output_fields=output_fields)
+        try:
+            while True:
+                rows = iterator.next()
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            iterator.close()
+
+    def model_versions(self):
+        """
+        Return the PCA model versions the stored vectors were projected with.
+        Scans the collection, so it is meant for maintenance rather than every request.
+        """
+        if not self.has_model_version:
+            return []
+        return sorted({row["model_version"] for row in self._scan("id >= 0", ["model_version"])})
+
+    def urls_by_model_version(self, model_version):
+        """
+        Return the urls of the images with vectors of a PCA model version.
+        """
+        if not self.has_model_version:
+            return []
+        return sorted({row["url"] for row in self._scan(f"model_version == {int(model_version)}", ["url"])})
+
+    def delete_by_ids(self, segment_ids, batch_size=None):
+        """
+        Delete segments by their primary keys and return the number deleted.
+        """
+        segment_ids = [int(segment_id) for segment_id in segment_ids]
+        batch_size = batch_size or self.insert_batch_size
+        for start in range(0, len(segment_ids), batch_size):
+            self.collection.delete(expr=f"id in {segment_ids[start:start + batch_size]}")
+        return len(segment_ids)
+
     def delete_by_vector(self, vector):
         """
         Delete a segment by its vector.
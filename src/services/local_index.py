@@ -0,0 +1,508 @@
+import os
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+import numpy as np
+from ..utils import Segment, GEOMETRY_FIELDS, log_message, file_lock, STAGE_SECONDS, timed
+
+
+class LocalVectorIndex:
+    """
+    Embedded vector index implementing the MilvusHandler interface without the Milvus stack.
+
+    Vectors are stored in a memory-mapped float32 file and the segment metadata (url, model
+    version, geometry, deletion flag) in a SQLite table, both under `<data_dir>/<collection_name>`.
+    Row ids are the primary keys. Search is exact brute force (squared L2, like Milvus) or,
+    with index_type="IVF_FLAT", restricted to the `nprobe` closest of `nlist` k-means clusters.
+
+    Several processes (e.g. the search and ingest workers) can open the same collection.
+    Ids are allocated and the vector file grown under SQLite's write lock, and deletions and
+    updates are logged in a `changes` table, so every instance catches up with what the
+    others committed before it reads.
+    """
+
+    def __init__(self, collection_name, data_dir="data/vector_index", dim=128, index_type="FLAT",
+                 nlist=128, nprobe=10, search_block_size=64 * 1024 * 1024):
+        self.collection_name = collection_name
+        self.directory = os.path.join(data_dir, collection_name)
+        self.dim = dim
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.search_block_size = search_block_size  # Most query-row distances computed at once in a flat search
+        self.has_model_version = True
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self.connect()
+        self.create_collection()
+
+    # Storage
+
+    def _connection(self):
+        """Return the calling thread's connection to the metadata store."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(os.path.join(self.directory, "segments.sqlite"), timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def connect(self):
+        os.makedirs(self.directory, exist_ok=True)
+        log_message('info', 'Using local vector index at %s.', self.directory)
+
+    def create_collection(self):
+        """
+        Create the metadata tables if needed and map the stored vectors.
+        """
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS segments ("
+                "id INTEGER PRIMARY KEY, url TEXT, model_version INTEGER DEFAULT 0, "
+                "centroid_row REAL, centroid_col REAL, bbox_min_row INTEGER, bbox_min_col INTEGER, "
+                "bbox_max_row INTEGER, bbox_max_col INTEGER, area INTEGER, deleted INTEGER DEFAULT 0)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS segments_url ON segments (url)")
+            connection.execute("CREATE INDEX IF NOT EXISTS segments_model_version ON segments (model_version)")
+            # Deletions and vector updates, replayed by the other processes sharing the collection
+            connection.execute("CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, id INTEGER, kind TEXT)")
+
+        self._vectors_path = os.path.join(self.directory, "vectors.f32")
+        self._capacity = 0
+        self._vectors = None
+        with self._write_transaction():
+            self._map_vectors(1024, grow=True)
+
+        # Keep the deletion mask, squared norms and model versions in memory for fast scans
+        self.count = 0
+        self._change_seq = 0
+        self._alive = np.ones(0, dtype=bool)
+        self._norms = np.zeros(0, dtype=np.float32)
+        self._model_versions = np.zeros(0, dtype=np.int64)
+        self._centroids = None
+        self._assignments = None
+        self._sync()
+        with self._lock:
+            self._build_ivf_when_ready()
+
+    @contextmanager
+    def _write_transaction(self):
+        """
+        Hold SQLite's write lock for the block, which serialises id allocation and growth of
+        the vector file across processes. Commits on success and rolls back on error.
+        """
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+
+    def _map_vectors(self, rows, grow=False):
+        """
+        Map the vector file so that it covers `rows` rows. Writers (grow=True, holding the
+        write lock) extend the file geometrically so appends stay amortised O(1); the file
+        only ever grows, so the mappings of other processes stay valid.
+        """
+        if rows <= self._capacity:
+            return
+        size = os.path.getsize(self._vectors_path) // (self.dim * 4) if os.path.exists(self._vectors_path) else 0
+        if size < rows:
+            if not grow:
+                raise RuntimeError(f"The vector file holds {size} rows, {rows} are committed.")
+            size = max(rows, size * 2, 1024)
+            with open(self._vectors_path, "ab") as file:
+                file.truncate(size * self.dim * 4)
+        if self._vectors is not None:
+            self._vectors.flush()
+            del self._vectors
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r+", shape=(size, self.dim))
+        self._capacity = size
+
+    def _sync(self):
+        """
+        Catch up with what other processes committed, when SQLite reports that they did.
+        """
+        connection = self._connection()
+        data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == getattr(self._local, "data_version", None):
+            return
+        with self._lock:
+            # One read transaction, so the new rows and the changes come from the same snapshot
+            connection.execute("BEGIN")
+            try:
+                self._catch_up(connection)
+            finally:
+                connection.commit()
+        self._local.data_version = data_version
+
+    def _catch_up(self, connection):
+        """Append the rows and replay the changes committed since the last catch up. Call with _lock held."""
+        count = connection.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM segments").fetchone()[0]
+        if count > self.count:
+            self._map_vectors(count)
+            alive = np.ones(count - self.count, dtype=bool)
+            model_versions = np.zeros(count - self.count, dtype=np.int64)
+            for row_id, deleted, model_version in connection.execute(
+                "SELECT id, deleted, model_version FROM segments WHERE id >= ?", (self.count,)
+            ):
+                alive[row_id - self.count] = not deleted
+                model_versions[row_id - self.count] = model_version
+            vectors = self._vectors[self.count:count]
+            self._alive = np.concatenate([self._alive, alive])
+            self._model_versions = np.concatenate([self._model_versions, model_versions])
+            self._norms = np.concatenate([self._norms, np.einsum('ij,ij->i', vectors, vectors)])
+            if self._centroids is not None:
+                self._assignments = np.concatenate([self._assignments, self._nearest_centroid(vectors)])
+            self.count = count
+
+        for seq, row_id, kind in connection.execute(
+            "SELECT seq, id, kind FROM changes WHERE seq > ? ORDER BY seq", (self._change_seq,)
+        ).fetchall():
+            if kind == "delete":
+                self._alive[row_id] = False
+            else:
+                vector = np.asarray(self._vectors[row_id])
+                self._norms[row_id] = vector @ vector
+                self._model_versions[row_id] = connection.execute(
+                    "SELECT model_version FROM segments WHERE id = ?", (row_id,)
+                ).fetchone()[0]
+                if self._centroids is not None:
+                    self._assignments[row_id] = self._nearest_centroid(vector[None, :])[0]
+            self._change_seq = seq
+
+        if self.index_type == "IVF_FLAT" and self._centroids is None:
+            self._load_ivf()
+
+    # Index
+
+    def create_index(self, index_type="IVF_FLAT", metric_type="L2", nlist=128):
+        """
+        Build the IVF index: k-means centroids over the stored vectors and the cluster of every row.
+        """
+        if metric_type != "L2":
+            raise ValueError("The local index only supports the L2 metric.")
+        with self._lock:
+            self.index_type = index_type
+            self.nlist = nlist
+            if index_type != "IVF_FLAT":
+                self._centroids = self._assignments = None
+                return
+
+            vectors = self._vectors[:self.count][self._alive]
+            if len(vectors) < nlist:
+                # Built by the first insert that brings enough vectors
+                log_message('info', 'Not enough vectors for %d clusters, searching exhaustively for now.', nlist)
+                self._centroids = self._assignments = None
+                return
+
+            self._centroids = self._kmeans(vectors, nlist)
+            self._assignments = self._nearest_centroid(self._vectors[:self.count])
+            # Saved atomically, as other processes load them as soon as they appear
+            for name, array in (("assignments.npy", self._assignments), ("centroids.npy", self._centroids)):
+                path = os.path.join(self.directory, name)
+                with open(f"{path}.tmp", "wb") as file:
+                    np.save(file, array)
+                os.replace(f"{path}.tmp", path)
+            log_message('info', 'Index IVF_FLAT with %d clusters built over %d vectors.', nlist, len(vectors))
+
+    def _load_ivf(self):
+        """Load the IVF index saved by this or another process, if there is one."""
+        centroids_path = os.path.join(self.directory, "centroids.npy")
+        assignments_path = os.path.join(self.directory, "assignments.npy")
+        if os.path.exists(centroids_path) and os.path.exists(assignments_path):
+            self._centroids = np.load(centroids_path)
+            assignments = np.load(assignments_path)[:self.count]
+            # Rows appended since the index was saved are assigned now
+            missing = self._nearest_centroid(self._vectors[len(assignments):self.count])
+            self._assignments = np.concatenate([assignments, missing])
+
+    def _build_ivf_when_ready(self):
+        """Build the IVF index once enough vectors were inserted. Call with _lock held."""
+        if self.index_type == "IVF_FLAT" and self._centroids is None and np.count_nonzero(self._alive) >= self.nlist:
+            # One process builds it; the others load it on their next catch up
+            with file_lock(os.path.join(self.directory, "index.lock")):
+                self._load_ivf()
+                if self._centroids is None:
+                    self.create_index("IVF_FLAT", nlist=self.nlist)
+
+    @staticmethod
+    def _kmeans(vectors, n_clusters, iterations=10, sample_size=100000, seed=0):
+        rng = np.random.default_rng(seed)
+        if len(vectors) > sample_size:
+            vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+        vectors = np.asarray(vectors, dtype=np.float32)
+        centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+        for _ in range(iterations):
+            distances = np.einsum('ij,ij->i', vectors, vectors)[:, None] - 2 * vectors @ centroids.T + np.einsum('ij,ij->i', centroids, centroids)[None, :]
+            labels = np.argmin(distances, axis=1)
+            counts = np.bincount(labels, minlength=n_clusters)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, vectors)
+            non_empty = counts > 0
+            centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+        return centroids
+
+    def _nearest_centroid(self, vectors):
+        if len(vectors) == 0:
+            return np.empty(0, dtype=np.int32)
+        distances = -2 * vectors @ self._centroids.T + np.einsum('ij,ij->i', self._centroids, self._centroids)[None, :]
+        return np.argmin(distances, axis=1).astype(np.int32)
+
+    # Writes
+
+    def insert_segment(self, segment):
+        """
+        Insert a Segment object into the index.
+        """
+        return self.insert_segments([segment.vector], [segment.centroid], [segment.url], [segment.model_version],
+                                    [segment.bbox], [segment.area])
+
+    @timed(STAGE_SECONDS.labels("local_index_insert"))
+    def insert_segments(self, vectors, centroids, urls, model_versions=0, bboxes=None, areas=None, batch_size=None):
+        """
+        Insert a batch of segments and return their primary keys in insertion order.
+        Accepts the same arguments as MilvusHandler.insert_segments.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+            raise ValueError(f"Vectors must be a 2D array of shape (n, {self.dim}).")
+        centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 2)
+        urls = [urls] * len(vectors) if isinstance(urls, str) else list(urls)
+        model_versions = [int(model_versions)] * len(vectors) if np.isscalar(model_versions) else [int(version) for version in model_versions]
+        bboxes = np.asarray(bboxes, dtype=np.int64).reshape(-1, 4) if bboxes is not None else np.full((len(vectors), 4), -1)
+        areas = [int(area) for area in areas] if areas is not None else [0] * len(vectors)
+        if not len(vectors) == len(centroids) == len(urls) == len(model_versions) == len(bboxes) == len(areas):
+            raise ValueError("Vectors, centroids, urls, model versions, bboxes and areas must have the same length.")
+
+        with self._lock:
+            with self._write_transaction() as connection:
+                # Ids follow the rows committed by every process; the vectors are in place before the rows are visible
+                self._catch_up(connection)
+                start = self.count
+                end = start + len(vectors)
+                self._map_vectors(end, grow=True)
+                self._vectors[start:end] = vectors
+                self._vectors.flush()
+                ids = list(range(start, end))
+                connection.executemany(
+                    f"INSERT INTO segments (id, url, model_version, {', '.join(GEOMETRY_FIELDS)}) VALUES ({', '.join('?' * 10)})",
+                    zip(ids, urls, model_versions, *centroids.T.tolist(), *bboxes.T.tolist(), areas)
+                )
+            self._alive = np.concatenate([self._alive, np.ones(len(vectors), dtype=bool)])
+            self._norms = np.concatenate([self._norms, np.einsum('ij,ij->i', vectors, vectors)])
+            self._model_versions = np.concatenate([self._model_versions, np.asarray(model_versions, dtype=np.int64)])
+            if self._centroids is not None:
+                self._assignments = np.concatenate([self._assignments, self._nearest_centroid(vectors)])
+            self.count = end
+            self._build_ivf_when_ready()
+
+        log_message('info', '%d segments inserted into the local index.', len(ids))
+        return ids
+
+    def update_segment(self, segment_id, new_segment=None):
+        """
+        Update a segment based on its ID.
+        """
+        if not new_segment:
+            raise ValueError("No fields to update provided.")
+        with self._lock:
+            vector = np.asarray(new_segment.vector, dtype=np.float32)
+            with self._write_transaction() as connection:
+                self._catch_up(connection)
+                self._vectors[segment_id] = vector
+                self._vectors.flush()
+                row = new_segment.to_row()
+                connection.execute(
+                    f"UPDATE segments SET {', '.join(f'{field} = ?' for field in row)} WHERE id = ?", (*row.values(), segment_id)
+                )
+                connection.execute("INSERT INTO changes (id, kind) VALUES (?, 'update')", (segment_id,))
+            self._norms[segment_id] = vector @ vector
+            self._model_versions[segment_id] = new_segment.model_version
+            if self._centroids is not None:
+                self._assignments[segment_id] = self._nearest_centroid(vector[None, :])[0]
+        log_message('info', 'Segment with ID %d updated.', segment_id)
+        return segment_id
+
+    def ids_by_url(self, url):
+        """
+        Return the primary keys of every segment of an image url.
+        """
+        rows = self._connection().execute("SELECT id FROM segments WHERE url = ? AND deleted = 0", (url,)).fetchall()
+        return [row[0] for row in rows]
+
+    def segments_by_url(self, url):
+        """
+        Return (id, Segment) pairs of every segment of an image url.
+        """
+        segment_ids = self.ids_by_url(url)
+        self._sync()
+        with self._lock:
+            segments = self._segments_by_id(segment_ids)
+        return [(segment_id, segments[segment_id]) for segment_id in segment_ids]
+
+    def model_versions(self):
+        """
+        Return the PCA model versions the stored vectors were projected with.
+        """
+        rows = self._connection().execute("SELECT DISTINCT model_version FROM segments WHERE deleted = 0").fetchall()
+        return sorted(row[0] for row in rows)
+
+    def urls_by_model_version(self, model_version):
+        """
+        Return the urls of the images with vectors of a PCA model version.
+        """
+        rows = self._connection().execute(
+            "SELECT DISTINCT url FROM segments WHERE model_version = ? AND deleted = 0", (int(model_version),)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def delete_by_ids(self, segment_ids):
+        """
+        Delete segments by their primary keys and return the number deleted.
+        """
+        with self._lock:
+            with self._write_transaction() as connection:
+                self._catch_up(connection)
+                segment_ids = [int(segment_id) for segment_id in segment_ids if 0 <= int(segment_id) < self.count]
+                connection.executemany("UPDATE segments SET deleted = 1 WHERE id = ?", [(segment_id,) for segment_id in segment_ids])
+                connection.executemany("INSERT INTO changes (id, kind) VALUES (?, 'delete')", [(segment_id,) for segment_id in segment_ids])
+            self._alive[segment_ids] = False
+        return len(segment_ids)
+
+    def delete_by_vector(self, vector):
+        """
+        Delete the segment closest to the vector.
+        """
+        matches = self.find_by_vectors([vector], top_k=1)
+        if matches and matches[0]:
+            return self.delete_by_ids([matches[0][0][0]])
+        return 0  # No vector found
+
+    # Reads
+
+    def _segments_by_id(self, segment_ids):
+        """Load the Segments of the given ids, keyed by id."""
+        if len(segment_ids) == 0:
+            return {}
+        placeholders = ",".join("?" * len(segment_ids))
+        columns = ("id", "url", "model_version") + GEOMETRY_FIELDS
+        rows = self._connection().execute(
+            f"SELECT {', '.join(columns)} FROM segments WHERE id IN ({placeholders})", [int(segment_id) for segment_id in segment_ids]
+        ).fetchall()
+        segments = {}
+        for row in rows:
+            data = dict(zip(columns, row))
+            segments[row[0]] = Segment.from_dict({"vector": self._vectors[row[0]].tolist(), **data})
+        return segments
+
+    def get_segments(self):
+        """
+        Retrieve all segments in the index (returning as Segment objects).
+        """
+        self._sync()
+        with self._lock:
+            segments = self._segments_by_id(np.flatnonzero(self._alive).tolist())
+        return [segments[segment_id] for segment_id in sorted(segments)]
+
+    def find_by_id(self, segment_id):
+        """
+        Find a Segment by its primary key.
+        """
+        self._sync()
+        with self._lock:
+            if not 0 <= segment_id < self.count or not self._alive[segment_id]:
+                return None
+            return self._segments_by_id([segment_id]).get(segment_id)
+
+    def find_by_vector(self, vector, top_k=1, model_version=None):
+        """
+        Search for the closest segment by vector similarity (squared L2 distance).
+        """
+        matches = self.find_by_vectors([vector], top_k=top_k, model_version=model_version)
+        if matches and matches[0]:
+            return matches[0][0][2]
+        return None
+
+    @timed(STAGE_SECONDS.labels("local_index_search"))
+    def find_by_vectors(self, vectors, top_k=5, nprobe=None, model_version=None):
+        """
+        Search for the top_k most similar segments of several vectors at once.
+        With model_version, only vectors projected with that PCA model version are compared.
+
+        Returns one list per query vector, each containing (id, distance, Segment) tuples
+        ordered from the closest to the furthest hit.
+        """
+        queries = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        if len(queries) == 0:
+            return []
+        nprobe = nprobe or self.nprobe
+
+        self._sync()
+        with self._lock:
+            searchable = self._alive if model_version is None else self._alive & (self._model_versions == model_version)
+            if self._centroids is None:
+                hits = self._flat_search(queries, top_k, searchable)
+            else:
+                hits = []
+                for query in queries:
+                    candidates = self._candidates(query, nprobe, searchable)
+                    distances = self._norms[candidates] - 2 * (self._vectors[candidates] @ query) + query @ query
+                    hits.append(self._nearest(candidates, distances, top_k))
+
+            segments = self._segments_by_id(sorted({segment_id for ids, _ in hits for segment_id in ids}))
+
+        return [
+            [(segment_id, distance, segments[segment_id]) for segment_id, distance in zip(ids, distances)]
+            for ids, distances in hits
+        ]
+
+    def _flat_search(self, queries, top_k, searchable):
+        """
+        Exact search of every searchable row. The queries are compared to all rows with one
+        matmul per block of queries, straight from the memory map; the other rows are masked afterwards.
+        """
+        count = self.count
+        rows = np.arange(count)
+        vectors = self._vectors[:count]
+        norms = self._norms[:count]
+        dead = ~searchable[:count]
+        block = max(1, self.search_block_size // max(count, 1))
+        hits = []
+        for start in range(0, len(queries), block):
+            block_queries = queries[start:start + block]
+            distances = norms[None, :] - 2 * (block_queries @ vectors.T) + np.einsum('ij,ij->i', block_queries, block_queries)[:, None]
+            distances[:, dead] = np.inf
+            hits.extend(self._nearest(rows, query_distances, top_k) for query_distances in distances)
+        return hits
+
+    @staticmethod
+    def _nearest(rows, distances, top_k):
+        """The top_k (ids, distances) of a query, closest first, leaving out masked rows."""
+        k = min(top_k, len(rows))
+        if k == 0:
+            return [], []
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        nearest = nearest[np.isfinite(distances[nearest])]
+        return rows[nearest].tolist(), distances[nearest].tolist()
+
+    def _candidates(self, query, nprobe, searchable):
+        """Row ids to scan for an IVF search: the searchable rows of the nprobe closest clusters."""
+        centroid_distances = -2 * self._centroids @ query + np.einsum('ij,ij->i', self._centroids, self._centroids)
+        probes = np.argpartition(centroid_distances, min(nprobe, len(self._centroids)) - 1)[:nprobe]
+        return np.flatnonzero(np.isin(self._assignments, probes) & searchable)
+
+    def close_connection(self):
+        """
+        Flush the vectors to disk and close the metadata store of the calling thread.
+        """
+        with self._lock:
+            self._vectors.flush()
+            connection = getattr(self._local, "connection", None)
+            if connection is not None:
+                connection.close()
+                self._local.connection = None
@@ -1,55 +1,78 @@
 import numpy as np
 import base64
-from .logging import log_message
+
+# Scalar geometry columns stored next to each vector, in schema order
+GEOMETRY_FIELDS = ("centroid_row", "centroid_col", "bbox_min_row", "bbox_min_col", "bbox_max_row", "bbox_max_col", "area")
+
 
 class Segment:
-    def __init__(self, vector, path, url):
+    """
+    A superpixel segment: its reduced feature vector, source url and geometry.
+
+    Geometry is kept as plain scalars (centroid, bounding box with exclusive max, pixel area)
+    so that it maps one-to-one onto typed database fields. A bbox of -1s and an area of 0
+    mean the geometry is unknown, as for rows migrated from base64-encoded paths.
+    """
+    __slots__ = ("vector", "centroid", "bbox", "area", "url", "model_version")
+
+    def __init__(self, vector, path, url, bbox=None, area=0, model_version=0):
         """
-        Initialize a Segment object with a 128-float vector and a 2D numpy array.
+        Initialize a Segment object with a 128-float vector and its (row, col) centroid as `path`.
         """
         if len(vector) != 128:
             raise ValueError("Vector must be 128 floats long.")
         self.vector = vector
-        self.path = self.encode_path(path)
+        self.centroid = (float(path[0]), float(path[1]))
+        self.bbox = tuple(int(value) for value in bbox) if bbox is not None else (-1, -1, -1, -1)
+        self.area = int(area)
         self.url = url
+        self.model_version = int(model_version)
 
-    def encode_path(self, path):
-        """
-        Convert numpy array to bytes and then encode it to base64 string.
-        """
-        # Convert numpy array to bytes
-        path_bytes = path.tobytes()
-        # Encode the bytes to base64 string
-        path_base64 = base64.b64encode(path_bytes).decode('utf-8')
-        log_message('info', f'{path_base64=}')
-        return path_base64
+    @property
+    def path(self):
+        return list(self.centroid)
 
     @classmethod
     def get_path(cls, encoded_path):
         """
-        Decode the base64 string back into a numpy array.
+        Decode a legacy base64 path string back into a numpy array.
         """
-        # Decode the base64 string into bytes
         path_bytes = base64.b64decode(encoded_path)
-        # Convert the bytes back into a numpy array
-        path = np.frombuffer(path_bytes, dtype=np.float64)  # Use the original dtype of the array
-        return path
-       
+        return np.frombuffer(path_bytes, dtype=np.float64)  # Legacy paths were float64 arrays
+
+    def to_row(self):
+        """
+        Return the geometry as a dict of the scalar database fields.
+        """
+        return dict(zip(GEOMETRY_FIELDS, (*self.centroid, *self.bbox, self.area)))
+
     def to_dict(self):
         """
-        Convert the Segment object to a dictionary for MongoDB storage.
+        Convert the Segment object to a dictionary for API responses.
         """
         return {
             "vector": self.vector,
-            "path": self.get_path(self.path).tolist(),
+            "path": self.path,
+            "bbox": list(self.bbox),
+            "area": self.area,
             "url": self.url
         }
 
     @classmethod
     def from_dict(cls, data):
         """
-        Create a Segment object from a dictionary retrieved from MongoDB.
+        Create a Segment object from a database row: either scalar geometry fields,
+        a legacy base64 "path" string, or a "path" centroid list.
         """
-        path = cls.get_path(data["path"])
-        url = data["url"]
-        return cls(vector=data["vector"], path=path, url=url)
+        if "centroid_row" in data:
+            path = (data["centroid_row"], data["centroid_col"])
+            bbox = (data["bbox_min_row"], data["bbox_min_col"], data["bbox_max_row"], data["bbox_max_col"])
+            area = data["area"]
+        else:
+            path = data["path"]
+            if isinstance(path, str):
+                path = cls.get_path(path)
+            bbox = data.get("bbox")
+            area = data.get("area", 0)
+        return cls(vector=data["vector"], path=path, url=data.get("url"), bbox=bbox, area=area,
+                   model_version=data.get("model_version") or 0)
@@ -2,10 +2,14 @@ from enum import Enum
 
 
 class PipelineLevel(Enum):
+    DOWNLOAD = 'Download'
     SEGMENTATION = 'Segmentation'
     FEATURE_EXTRACTION = 'FeatureExtraction'
     DIMENSIONALITY_REDUCTION = 'DimensionalityReduction'
+    STORAGE = 'Storage'
     CLUSTERING = 'Clustering'
+    COMPLETED = 'Completed'
+    FAILED = 'Failed'
 
 
 class WorkItem:
@@ -1,4 +1,13 @@
-from .Segment import Segment
+from .Segment import Segment, GEOMETRY_FIELDS
 from .logging import *
-from .WorkItems import WorkItem
+from .metrics import (
+    Counter, Gauge, Histogram, timed, generate_latest, start_metrics_server, CONTENT_TYPE,
+    STAGE_SECONDS, SEGMENTS, TASK_SECONDS, TASK_QUEUE_WAIT_SECONDS, CACHE_REQUESTS,
+    INFERENCE_QUEUE_DEPTH, INFERENCE_BATCH_SIZE
+)
+from .WorkItems import WorkItem, PipelineLevel
+from .file_lock import file_lock
+from .image_cache import ImageCache, get_image_cache
+from .query_cache import QueryCache
+from .ingest_registry import IngestRegistry
 from .image_processing import *
\ No newline at end of file
@@ -0,0 +1,21 @@
+import os
+import fcntl
+from contextlib import contextmanager
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """
+    Hold an advisory lock on `path` (created if missing) for the duration of the block.
+    The lock is taken on a fresh file descriptor, so it excludes other threads of this
+    process as well as other processes. With shared=True several holders may share it.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "a") as file:
+        fcntl.flock(file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
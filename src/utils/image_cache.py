@@ -0,0 +1,292 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import requests
+from .logging import log_message
+from .metrics import CACHE_REQUESTS
+
+_HITS = CACHE_REQUESTS.labels("image", "hit")
+_MISSES = CACHE_REQUESTS.labels("image", "miss")
+_REVALIDATIONS = CACHE_REQUESTS.labels("image", "revalidated")
+
+
+class ImageCache:
+    """
+    Disk-backed, size-bounded LRU cache for downloaded images.
+
+    Entries are keyed by URL and point to a blob named after the SHA-256 of its content,
+    so identical images fetched from different URLs are stored once. Entries older than
+    `max_age` seconds are revalidated with a conditional request (ETag / Last-Modified)
+    before being served again.
+
+    Attributes:
+    ----------
+    cache_dir : str
+        Directory holding the `entries` (metadata) and `blobs` (content) sub-directories.
+    max_bytes : int
+        Upper bound on the total size of the stored blobs.
+    max_age : float
+        Number of seconds an entry is served without revalidation.
+    """
+
+    def __init__(self, cache_dir="cache/images", max_bytes=2 * 1024 ** 3, max_age=24 * 3600, timeout=30, chunk_size=1024 * 1024, pool_size=32):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.entries_dir = os.path.join(cache_dir, "entries")
+        self.blobs_dir = os.path.join(cache_dir, "blobs")
+        os.makedirs(self.entries_dir, exist_ok=True)
+        os.makedirs(self.blobs_dir, exist_ok=True)
+
+        # A single pooled session shared by every thread using the cache
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()  # url key -> metadata, least recently used first
+        self._blob_sizes = {}  # content hash -> size in bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self._load_index()
+
+    @staticmethod
+    def _url_key(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.entries_dir, f"{key}.json")
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.blobs_dir, content_hash)
+
+    def _load_index(self):
+        """Rebuild the in-memory index from the metadata files, ordered by last access."""
+        entries = []
+        for filename in os.listdir(self.entries_dir):
+            if not filename.endswith(".json"):
+                continue
+            entry_path = os.path.join(self.entries_dir, filename)
+            try:
+                with open(entry_path, "r") as file:
+                    meta = json.load(file)
+                blob_path = self._blob_path(meta["content_hash"])
+                if not os.path.exists(blob_path):
+                    os.remove(entry_path)
+                    continue
+                entries.append((os.path.getmtime(entry_path), filename[:-len(".json")], meta))
+                self._blob_sizes[meta["content_hash"]] = os.path.getsize(blob_path)
+            except (OSError, ValueError, KeyError):
+                log_message('warning', 'Ignoring unreadable cache entry %s', entry_path, path=entry_path)
+
+        for _, key, meta in sorted(entries, key=lambda entry: entry[0]):
+            self._entries[key] = meta
+
+        # Blobs left behind by content that changed before the entries were last written
+        for filename in os.listdir(self.blobs_dir):
+            if not filename.startswith(".") and filename not in self._blob_sizes:
+                try:
+                    os.remove(self._blob_path(filename))
+                except OSError:
+                    pass
+
+    def _write_entry(self, key, meta):
+        entry_path = self._entry_path(key)
+        tmp_path = f"{entry_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(meta, file)
+        os.replace(tmp_path, entry_path)
+
+    def _touch(self, key):
+        """Mark an entry as most recently used, in memory and on disk."""
+        self._entries.move_to_end(key)
+        try:
+            os.utime(self._entry_path(key))
+        except OSError:
+            pass
+
+    def _download(self, url, headers=None):
+        """
+        Stream the response body into the blob store, hashing it on the fly.
+        Returns the response and the content hash, or (response, None) for a 304.
+        """
+        response = self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+        if response.status_code == 304:
+            response.close()
+            return response, None
+        response.raise_for_status()
+
+        digest = hashlib.sha256()
+        tmp_path = os.path.join(self.blobs_dir, f".{self._url_key(url)}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, "wb") as file:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    digest.update(chunk)
+                    file.write(chunk)
+            content_hash = digest.hexdigest()
+            os.replace(tmp_path, self._blob_path(content_hash))
+        finally:
+            response.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return response, content_hash
+
+    def open(self, url):
+        """
+        Return an open binary file of the cached content of `url`, downloading or revalidating it if needed.
+        The file is opened while the cache is locked, so it stays readable even if another thread
+        evicts the entry right after.
+        """
+        key = self._url_key(url)
+        conditional = True
+        while True:
+            with self._lock:
+                meta = self._entries.get(key)
+                if meta is not None and time.time() - meta["fetched_at"] < self.max_age:
+                    file = self._open_blob(meta["content_hash"])
+                    if file is not None:
+                        self.hits += 1
+                        _HITS.inc()
+                        self._touch(key)
+                        return file
+
+            # Conditional request when a stale entry exists; the lock is not held while downloading
+            headers = {}
+            if meta is not None and conditional:
+                if meta.get("etag"):
+                    headers["If-None-Match"] = meta["etag"]
+                if meta.get("last_modified"):
+                    headers["If-Modified-Since"] = meta["last_modified"]
+
+            response, content_hash = self._download(url, headers=headers)
+
+            with self._lock:
+                if content_hash is None:
+                    file = self._open_blob(meta["content_hash"])
+                    if file is not None:
+                        # Not modified: the cached blob is still valid
+                        self.hits += 1
+                        self.revalidations += 1
+                        _REVALIDATIONS.inc()
+                        meta["fetched_at"] = time.time()
+                        self._entries[key] = meta
+                        self._write_entry(key, meta)
+                        self._touch(key)
+                        return file
+
+                    # Not modified, but the blob was evicted in the meantime: download it again
+                    conditional = False
+                    continue
+
+                file = self._open_blob(content_hash)
+                if file is None:
+                    # Evicted by another thread before it was recorded: download it again
+                    continue
+
+                self.misses += 1
+                _MISSES.inc()
+                previous = self._entries.pop(key, None)
+                self._entries[key] = {
+                    "url": url,
+                    "content_hash": content_hash,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "fetched_at": time.time(),
+                }
+                self._blob_sizes[content_hash] = os.fstat(file.fileno()).st_size
+                self._write_entry(key, self._entries[key])
+                if previous is not None and previous["content_hash"] != content_hash:
+                    # The content at the url changed: the old blob is garbage unless another url shares it
+                    self._drop_blob_if_unused(previous["content_hash"])
+                self._evict(keep=content_hash)
+                return file
+
+    def fetch(self, url):
+        """
+        Return the local path of the cached content of `url`, downloading or revalidating it if needed.
+        The entry can be evicted by another thread at any time; prefer `open` or `get` to read it.
+        """
+        with self.open(url) as file:
+            return file.name
+
+    def get(self, url):
+        """Return the cached content of `url` as bytes."""
+        with self.open(url) as file:
+            return file.read()
+
+    def _open_blob(self, content_hash):
+        """Open a blob for reading, or return None if it no longer exists. Call with the lock held."""
+        try:
+            return open(self._blob_path(content_hash), "rb")
+        except FileNotFoundError:
+            return None
+
+    def _drop_blob_if_unused(self, content_hash):
+        """Remove a blob once no entry refers to it. Call with the lock held; returns the bytes freed."""
+        if any(meta["content_hash"] == content_hash for meta in self._entries.values()):
+            return 0
+        size = self._blob_sizes.pop(content_hash, 0)
+        try:
+            os.remove(self._blob_path(content_hash))
+        except OSError:
+            pass
+        return size
+
+    def _evict(self, keep=None):
+        """Remove least recently used entries until the blobs fit in max_bytes."""
+        total = sum(self._blob_sizes.values())
+        for key in list(self._entries):
+            if total <= self.max_bytes:
+                break
+            content_hash = self._entries[key]["content_hash"]
+            if content_hash == keep:
+                continue
+            del self._entries[key]
+            try:
+                os.remove(self._entry_path(key))
+            except OSError:
+                pass
+            self.evictions += 1
+
+            # Only drop the blob once no other url refers to it
+            total -= self._drop_blob_if_unused(content_hash)
+
+    def stats(self):
+        """Return the hit/miss counters and the current size of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": sum(self._blob_sizes.values()),
+            }
+
+
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+
+def get_image_cache() -> ImageCache:
+    """
+    Return the process-wide image cache, creating it on first use.
+    The location and size can be configured with the HAP_IMAGE_CACHE_DIR and HAP_IMAGE_CACHE_MAX_BYTES environment variables.
+    """
+    global _image_cache
+    with _image_cache_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache(
+                cache_dir=os.environ.get("HAP_IMAGE_CACHE_DIR", "cache/images"),
+                max_bytes=int(os.environ.get("HAP_IMAGE_CACHE_MAX_BYTES", 2 * 1024 ** 3)),
+            )
+        return _image_cache
@@ -2,19 +2,32 @@ import requests
 from PIL import Image
 import io
 import numpy as np
+from skimage import segmentation
 from .logging import log_message
+from .image_cache import get_image_cache
+from .metrics import STAGE_SECONDS, timed
 
-def download_image(image_url: str) -> Image.Image:
+@timed(STAGE_SECONDS.labels("download"))
+def download_image(image_url: str, use_cache: bool = True) -> Image.Image:
     """
     Downloads an image from the given URL and converts it into a PIL Image object.
+    The image is served from the shared local image cache when possible.
 
     :param image_url: The URL of the image to download.
+    :param use_cache: Whether to go through the shared local image cache.
     :return: The downloaded image as a PIL Image object.
     """
     try:
+        if use_cache:
+            # Fetch the image through the cache and decode it from the local file
+            with get_image_cache().open(image_url) as file:
+                image = Image.open(file)
+                image.load()
+            return image
+
         # Send a GET request to fetch the image content
         image_response = requests.get(url=image_url)
-        log_message('info', f'{image_response=}')
+        log_message('debug', 'Image response %s', image_response.status_code, image_url=image_url)
         image_response.raise_for_status()  # Check if the request was successful
         
         # Convert the content to a PIL Image object
@@ -26,6 +39,7 @@ def download_image(image_url: str) -> Image.Image:
         return None
 
 
+@timed(STAGE_SECONDS.labels("crop"))
 def crop_image(image: Image.Image, boundary: list) -> Image.Image:
     """
     Crops the given PIL Image object using the specified boundary.
@@ -36,9 +50,29 @@ def crop_image(image: Image.Image, boundary: list) -> Image.Image:
     """
     try:
         # Cropping the image using the provided boundary
-        log_message('info', f'{image=} {tuple(boundary)=}')
+        log_message('debug', 'Cropping %s image', image.size, boundary=tuple(boundary))
         cropped_image = image.crop(tuple(boundary))
         return cropped_image
     except Exception as e:
         print(f"Failed to crop image: {e}")
         return None
+
+
+def slic_tile(tile: np.ndarray, n_segments: int, compactness: float, sigma: float) -> np.ndarray:
+    """
+    Runs SLIC superpixel segmentation on a single image tile.
+    Kept in this lightweight module so that tile worker processes do not import the models.
+
+    :param tile: The tile as a numpy array.
+    :param n_segments: The approximate number of superpixels in the tile.
+    :param compactness: The SLIC compactness.
+    :param sigma: The width of the Gaussian smoothing applied before segmentation.
+    :return: The int32 label image of the tile, labels starting at 1.
+    """
+    return segmentation.slic(
+        tile,
+        n_segments=n_segments,
+        compactness=compactness,
+        sigma=sigma,
+        start_label=1
+    ).astype(np.int32)
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import hashlib
+import threading
+
+
+class IngestRegistry:
+    """
+    Indexed record of what has been ingested, kept in a local SQLite file.
+
+    For every image url it stores the hash of the image content, the pipeline parameters it
+    was processed with, the PCA model version of its vectors and the number of segments, so
+    an ingest can tell whether an image has changed since it was last processed. It also
+    records which proteins ImageDownloader has finished downloading, and the images each bulk
+    ingest job has finished, so a job restarted under the same id resumes where it stopped.
+
+    Ingests of a url are serialised with claims: a worker claims the url before replacing its
+    vectors, and other workers wait for the claim to be released (or to expire, if its owner
+    died) before they look at the url again.
+
+    The file is shared by every thread and process that opens the same `store_path`; point
+    the workers of a host at the same file.
+    """
+
+    def __init__(self, store_path="data/ingest_registry.sqlite"):
+        self.store_path = store_path
+        self._local = threading.local()
+
+        directory = os.path.dirname(self.store_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                "url TEXT PRIMARY KEY, content_hash TEXT, params_hash TEXT, params TEXT, "
+                "model_version INTEGER, segment_count INTEGER, ingested_at REAL)"
+            )
+            connection.execute("CREATE TABLE IF NOT EXISTS proteins (name TEXT PRIMARY KEY, processed_at REAL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS claims (url TEXT PRIMARY KEY, owner TEXT, expires_at REAL)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS bulk_images ("
+                "job_id TEXT, protein TEXT, image_url TEXT, segment_count INTEGER, skipped INTEGER, "
+                "PRIMARY KEY (job_id, protein, image_url))"
+            )
+
+    def _connection(self):
+        """Return the calling thread's connection to the registry."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.store_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def content_hash(data):
+        """Hash image content given as bytes or a numpy array."""
+        return hashlib.sha256(data.tobytes() if hasattr(data, "tobytes") else data).hexdigest()
+
+    @staticmethod
+    def params_hash(params):
+        """Hash a dictionary of pipeline parameters independently of key order."""
+        return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def get(self, url):
+        """Return the record of an image url, or None if it was never ingested."""
+        row = self._connection().execute(
+            "SELECT content_hash, params_hash, params, model_version, segment_count, ingested_at FROM images WHERE url = ?",
+            (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "url": url,
+            "content_hash": row[0],
+            "params_hash": row[1],
+            "params": json.loads(row[2]),
+            "model_version": row[3],
+            "segment_count": row[4],
+            "ingested_at": row[5],
+        }
+
+    def is_current(self, url, content_hash, params, model_version=None):
+        """
+        Whether the url was ingested from the same content with the same parameters
+        (and, if model_version is given, with that PCA model version).
+        """
+        record = self.get(url)
+        return (
+            record is not None
+            and record["content_hash"] == content_hash
+            and record["params_hash"] == self.params_hash(params)
+            and (model_version is None or record["model_version"] == model_version)
+        )
+
+    def record(self, url, content_hash, params, model_version, segment_count):
+        """Record (or replace) the ingest of an image url."""
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO images (url, content_hash, params_hash, params, model_version, segment_count, ingested_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, content_hash, self.params_hash(params), json.dumps(params, sort_keys=True, default=str),
+                 int(model_version), int(segment_count), time.time())
+            )
+
+    @staticmethod
+    def new_owner():
+        """A claim owner id unique across threads, processes and hosts."""
+        return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}"
+
+    def claim(self, url, owner, ttl=3600, wait=0, poll_interval=0.5):
+        """
+        Claim the ingest of a url for `owner` for `ttl` seconds.
+        Returns True once claimed, or False if another owner still holds it after `wait` seconds.
+        """
+        deadline = time.monotonic() + wait
+        while not self._try_claim(url, owner, ttl):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(poll_interval)
+        return True
+
+    def _try_claim(self, url, owner, ttl):
+        connection = self._connection()
+        now = time.time()
+        # The write lock makes the check and the claim one atomic step across processes
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT owner, expires_at FROM claims WHERE url = ?", (url,)).fetchone()
+            claimed = row is None or row[0] == owner or row[1] <= now
+            if claimed:
+                connection.execute(
+                    "INSERT OR REPLACE INTO claims (url, owner, expires_at) VALUES (?, ?, ?)", (url, owner, now + ttl)
+                )
+        except BaseException:
+            connection.rollback()
+            raise
+        connection.commit()
+        return claimed
+
+    def release(self, url, owner):
+        """Release a claim; claims taken over by another owner after expiring are left alone."""
+        with self._connection() as connection:
+            connection.execute("DELETE FROM claims WHERE url = ? AND owner = ?", (url, owner))
+
+    def model_versions(self):
+        """PCA model versions the vectors of the recorded images were projected with."""
+        rows = self._connection().execute("SELECT DISTINCT model_version FROM images WHERE model_version IS NOT NULL").fetchall()
+        return sorted(row[0] for row in rows)
+
+    def set_model_version(self, url, model_version):
+        """Record that the vectors of an image were re-projected into another model version."""
+        with self._connection() as connection:
+            connection.execute("UPDATE images SET model_version = ? WHERE url = ?", (model_version, url))
+
+    def forget(self, url):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM images WHERE url = ?", (url,))
+
+    def is_protein_processed(self, name):
+        return self._connection().execute("SELECT 1 FROM proteins WHERE name = ?", (name,)).fetchone() is not None
+
+    def mark_protein_processed(self, name):
+        with self._connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO proteins (name, processed_at) VALUES (?, ?)", (name, time.time()))
+
+    def record_bulk_image(self, job_id, protein, image_url, segment_count, skipped):
+        """Record an image a bulk ingest job has finished."""
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO bulk_images (job_id, protein, image_url, segment_count, skipped) VALUES (?, ?, ?, ?, ?)",
+                (job_id, protein, image_url, segment_count, int(skipped))
+            )
+
+    def bulk_images(self, job_id, protein):
+        """Images of a protein a bulk ingest job has finished: {url: (segment_count, skipped)}."""
+        rows = self._connection().execute(
+            "SELECT image_url, segment_count, skipped FROM bulk_images WHERE job_id = ? AND protein = ?", (job_id, protein)
+        ).fetchall()
+        return {row[0]: (row[1], bool(row[2])) for row in rows}
+
+    def forget_bulk_job(self, job_id):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM bulk_images WHERE job_id = ?", (job_id,))
@@ -1,44 +1,102 @@
 import logging
+import logging.handlers
 import os
-import inspect
+import json
+import queue
+import atexit
 from datetime import datetime
 
-def setup_logger():
+__all__ = ['setup_logger', 'log_message', 'JsonFormatter']
+
+logger = logging.getLogger('hap')
+
+_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format records as one JSON object per line.
+    The message and every extra field are truncated to max_payload characters so that a
+    stray array or image in a log call cannot blow up the log files.
+    """
+
+    def __init__(self, max_payload=2000):
+        super().__init__()
+        self.max_payload = max_payload
+
+    def _cap(self, value):
+        if not isinstance(value, (int, float, bool)) and value is not None:
+            value = str(value)
+            if len(value) > self.max_payload:
+                value = f"{value[:self.max_payload]}... ({len(value)} chars)"
+        return value
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "message": self._cap(record.getMessage()),
+            "file": record.pathname,
+            "function": record.funcName,
+            "line": record.lineno,
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        for key, value in getattr(record, 'fields', {}).items():
+            entry[key] = self._cap(value)
+        if record.exc_info:
+            entry["exception"] = self._cap(self.formatException(record.exc_info))
+        return json.dumps(entry)
+
+
+def setup_logger(level=None, log_dir='logs', max_payload=None):
+    """
+    Write log records as JSON lines to a timestamped file in log_dir.
+
+    Records are handed to a QueueHandler and written by a background QueueListener thread,
+    so callers never wait on disk. The level and payload cap default to the HAP_LOG_LEVEL
+    and HAP_LOG_MAX_PAYLOAD environment variables. Calling it again is a no-op.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
     # Create a logs directory if it doesn't exist
-    if not os.path.exists('logs'):
-        os.makedirs('logs')
-    
-    # Timestamp for log filename
-    log_filename = datetime.now().strftime("logs/log_%Y%m%d_%H%M%S.log")
-    
-    # Setup basic configuration for logging
-    logging.basicConfig(
-        filename=log_filename,
-        level=logging.DEBUG,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-
-def log_message(level, message):
-   # Get the current frame and extract the calling function's line number
-    frame = inspect.currentframe().f_back
-    line_number = frame.f_lineno
-    function_name = frame.f_code.co_name
-    filename = frame.f_code.co_filename
-
-    # Custom message with line number info
-    log_msg = f"{message} | Called from {filename}:{function_name}, line {line_number}"
-
-    # Log based on the provided level
-    if level == 'info':
-        logging.info(log_msg)
-    elif level == 'warning':
-        logging.warning(log_msg)
-    elif level == 'error':
-        logging.error(log_msg)
-    elif level == 'debug':
-        logging.debug(log_msg)
-    else:
-        logging.info(log_msg)
-
-    pass
\ No newline at end of file
+    os.makedirs(log_dir, exist_ok=True)
+
+    # Timestamp and pid in the filename so that worker processes do not share a file
+    log_filename = os.path.join(log_dir, datetime.now().strftime(f"log_%Y%m%d_%H%M%S_{os.getpid()}.log"))
+    file_handler = logging.FileHandler(log_filename)
+    file_handler.setFormatter(JsonFormatter(max_payload or int(os.environ.get("HAP_LOG_MAX_PAYLOAD", 2000))))
+
+    level = level or os.environ.get("HAP_LOG_LEVEL", "info")
+    logger.setLevel(_LEVELS.get(level, level) if isinstance(level, str) else level)
+    records = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(records, file_handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def log_message(level, message, *args, **fields):
+    """
+    Log a message at the given level ('debug', 'info', 'warning' or 'error').
+
+    Pass values as %-style args (log_message('info', 'Inserted %d rows', count)) rather than
+    an f-string to skip formatting entirely when the level is disabled. Keyword arguments are
+    added as structured fields of the JSON record. The caller's file, function and line are
+    taken from the logging module itself.
+    """
+    levelno = _LEVELS.get(level, logging.INFO)
+    if not logger.isEnabledFor(levelno):
+        return
+    logger.log(levelno, message, *args, extra={"fields": fields} if fields else None, stacklevel=2)
@@ -0,0 +1,263 @@
+import time
+import functools
+import threading
+from bisect import bisect_left
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Latency buckets in seconds, from fast cache lookups up to whole-slide ingests
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Timer:
+    """Context manager observing the elapsed time of its block into a histogram child."""
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+def timed(child):
+    """
+    Decorator observing the duration of every call into a histogram child,
+    e.g. @timed(STAGE_SECONDS.labels("slic")).
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class _CounterChild:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labelnames, labelvalues):
+        yield f"{name}{_format_labels(labelnames, labelvalues)} {self.value}"
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is the +Inf bucket
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self, name, labelnames, labelvalues):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            bucket_labels = _format_labels(labelnames, labelvalues, f'le="{le}"')
+            yield f"{name}_bucket{bucket_labels} {cumulative}"
+        yield f"{name}_sum{_format_labels(labelnames, labelvalues)} {total}"
+        yield f"{name}_count{_format_labels(labelnames, labelvalues)} {cumulative}"
+
+
+class _Metric:
+    """
+    A metric family. With label names, `labels(*values)` returns the child for those values;
+    look children up once and keep them on hot paths. Without labels the family records itself.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._children[()] = self._new_child()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *labelvalues):
+        child = self._children.get(labelvalues)
+        if child is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {labelvalues}.")
+            with self._lock:
+                child = self._children.setdefault(labelvalues, self._new_child())
+        return child
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labelvalues, child in list(self._children.items()):
+            lines.extend(child.samples(self.name, self.labelnames, labelvalues))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+
+class Registry:
+    """Set of metrics rendered together in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered.")
+        self._metrics[metric.name] = metric
+
+    def expose(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def generate_latest(registry=None):
+    """Render every metric of the registry in the Prometheus text exposition format."""
+    return (registry or REGISTRY).expose()
+
+
+def start_metrics_server(port, host="0.0.0.0", registry=None):
+    """
+    Serve the registry at http://<host>:<port>/metrics from a daemon thread,
+    for processes such as Celery workers that have no web app of their own.
+    """
+    registry = registry or REGISTRY
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = generate_latest(registry).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes are too frequent to log
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+# Metrics of the pipelines, shared by the API and the workers
+
+STAGE_SECONDS = Histogram(
+    "hap_stage_seconds", "Latency of each pipeline stage in seconds.", ["stage"]
+)
+SEGMENTS = Counter(
+    "hap_segments_total", "Superpixel segments accepted or rejected by the variance filter.", ["result"]
+)
+TASK_SECONDS = Histogram(
+    "hap_task_seconds", "Duration of Celery tasks in seconds.", ["task", "state"]
+)
+TASK_QUEUE_WAIT_SECONDS = Histogram(
+    "hap_task_queue_wait_seconds", "Time between a task being sent and a worker starting it.", ["task"]
+)
+CACHE_REQUESTS = Counter(
+    "hap_cache_requests_total", "Cache lookups by cache and result (hit, miss or revalidated).", ["cache", "result"]
+)
+INFERENCE_QUEUE_DEPTH = Gauge(
+    "hap_inference_queue_depth", "Images waiting for the micro-batching inference scheduler."
+)
+INFERENCE_BATCH_SIZE = Histogram(
+    "hap_inference_batch_size", "Images per forward pass of the micro-batching inference scheduler.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+from .metrics import CACHE_REQUESTS
+
+_HITS = CACHE_REQUESTS.labels("query", "hit")
+_MISSES = CACHE_REQUESTS.labels("query", "miss")
+
+
+class QueryCache:
+    """
+    Bounded cache of reduced query vectors keyed by (image_url, boundary, model version,
+    inference mode of the feature extractor).
+
+    Entries live in an in-process LRU with a time-to-live. When `store_path` is given, entries
+    are also written to a local SQLite file so that every thread and worker process on the
+    machine shares them.
+
+    Attributes:
+    ----------
+    max_entries : int
+        Maximum number of entries kept in memory and in the shared store.
+    ttl : float
+        Number of seconds an entry stays valid.
+    store_path : str or None
+        Path of the shared SQLite store, or None for a purely in-process cache.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, store_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store_path = store_path
+        self._entries = OrderedDict()  # key -> (created_at, vector), least recently used first
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+        if self.store_path:
+            directory = os.path.dirname(self.store_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with self._connection() as connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS query_vectors (key TEXT PRIMARY KEY, vector BLOB, created_at REAL)"
+                )
+                connection.execute("CREATE INDEX IF NOT EXISTS query_vectors_created_at ON query_vectors (created_at)")
+
+    @staticmethod
+    def make_key(image_url, boundary, model_version, inference_mode=None):
+        # The inference mode (backend, precision, ...) changes the features, so it is part of the key
+        return json.dumps([image_url, [float(value) for value in boundary], model_version, inference_mode], sort_keys=True)
+
+    def _connection(self):
+        """Return the calling thread's connection to the shared store."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.store_path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, image_url, boundary, model_version, inference_mode=None):
+        """Return the cached vector, or None if it is missing or expired."""
+        key = self.make_key(image_url, boundary, model_version, inference_mode)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    _HITS.inc()
+                    return entry[1]
+                del self._entries[key]
+
+        if self.store_path:
+            row = self._connection().execute(
+                "SELECT vector, created_at FROM query_vectors WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] < self.ttl:
+                vector = np.frombuffer(row[0], dtype=np.float32)
+                with self._lock:
+                    self._store(key, row[1], vector)
+                    self.hits += 1
+                _HITS.inc()
+                return vector
+
+        with self._lock:
+            self.misses += 1
+        _MISSES.inc()
+        return None
+
+    def put(self, image_url, boundary, model_version, vector, inference_mode=None):
+        key = self.make_key(image_url, boundary, model_version, inference_mode)
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        created_at = time.time()
+        with self._lock:
+            self._store(key, created_at, vector)
+
+        if self.store_path:
+            with self._connection() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO query_vectors (key, vector, created_at) VALUES (?, ?, ?)",
+                    (key, vector.tobytes(), created_at)
+                )
+                connection.execute("DELETE FROM query_vectors WHERE created_at < ?", (created_at - self.ttl,))
+                # Keep the store to the newest max_entries entries
+                connection.execute(
+                    "DELETE FROM query_vectors WHERE key IN "
+                    "(SELECT key FROM query_vectors ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+
+    def _store(self, key, created_at, vector):
+        self._entries[key] = (created_at, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+            }
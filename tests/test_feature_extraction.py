@@ -0,0 +1,8 @@
+import pytest
+from src.data_processing import FeatureExtractor
+
+
+def test_dynamic_int8_is_rejected():
+    # Dynamic quantization has no Linear layer left to quantize in the headless ResNet
+    with pytest.raises(ValueError, match="int8-static"):
+        FeatureExtractor(precision='int8-dynamic', pretrained=False)
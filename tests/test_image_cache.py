@@ -0,0 +1,114 @@
+import os
+import threading
+import pytest
+from src.utils import ImageCache
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        yield self.content
+
+    def close(self):
+        pass
+
+
+class FakeSession:
+    """Serves `contents[url]`, answering conditional requests with 304 while the ETag matches."""
+
+    def __init__(self, contents, on_get=None):
+        self.contents = contents
+        self.on_get = on_get
+        self.requests = []
+
+    def get(self, url, headers=None, stream=True, timeout=None):
+        self.requests.append((url, dict(headers or {})))
+        if self.on_get is not None:
+            self.on_get()
+        content = self.contents[url]
+        etag = str(hash(content))
+        if (headers or {}).get("If-None-Match") == etag:
+            return FakeResponse(304)
+        return FakeResponse(200, content, {"ETag": etag})
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ImageCache(cache_dir=str(tmp_path), max_bytes=1024)
+    cache.session = FakeSession({})
+    return cache
+
+
+def test_hit_after_miss(cache):
+    cache.session.contents["http://x/a"] = b"a" * 10
+    assert cache.get("http://x/a") == b"a" * 10
+    assert cache.get("http://x/a") == b"a" * 10
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert len(cache.session.requests) == 1
+
+
+def test_open_file_survives_eviction(cache):
+    cache.session.contents.update({"http://x/a": b"a" * 600, "http://x/b": b"b" * 600})
+    with cache.open("http://x/a") as file:
+        cache.get("http://x/b")  # Evicts a
+        assert cache.stats()["entries"] == 1
+        assert file.read() == b"a" * 600
+
+
+def test_changed_content_drops_the_old_blob(cache):
+    cache.max_age = 0
+    cache.session.contents["http://x/a"] = b"old"
+    cache.get("http://x/a")
+    cache.session.contents["http://x/a"] = b"new"
+    assert cache.get("http://x/a") == b"new"
+    assert len(os.listdir(cache.blobs_dir)) == 1
+    assert cache.stats()["bytes"] == 3
+
+
+def test_not_modified_after_eviction_downloads_without_the_lock(cache):
+    cache.max_age = 0
+    cache.session.contents["http://x/a"] = b"a" * 10
+    cache.get("http://x/a")
+    os.remove(cache._blob_path(cache._entries[cache._url_key("http://x/a")]["content_hash"]))
+
+    lock_free = []
+
+    def check_lock():
+        # Another thread must be able to use the cache while this one downloads
+        thread = threading.Thread(target=lambda: lock_free.append(cache._lock.acquire(timeout=1) and cache._lock.release() is None))
+        thread.start()
+        thread.join()
+
+    cache.session.on_get = check_lock
+    assert cache.get("http://x/a") == b"a" * 10
+    assert cache.session.requests[-2][1].get("If-None-Match")  # Revalidation answered with 304
+    assert cache.session.requests[-1][1] == {}  # Unconditional download of the evicted blob
+    assert lock_free == [True, True]
+
+
+def test_concurrent_readers_never_see_a_missing_file(cache):
+    cache.max_bytes = 2000
+    urls = [f"http://x/{i}" for i in range(8)]
+    cache.session.contents.update({url: url.encode() * 100 for url in urls})
+    errors = []
+
+    def read(url):
+        try:
+            for _ in range(20):
+                assert cache.get(url) == url.encode() * 100
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read, args=(url,)) for url in urls]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
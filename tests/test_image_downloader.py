@@ -0,0 +1,55 @@
+import io
+import sys
+import pytest
+import requests
+from src.data_processing import ImageDownloader
+from src.utils import IngestRegistry
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b""):
+        self.status_code = status_code
+        self.content = content
+        self.raw = io.BytesIO(content)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+@pytest.fixture
+def downloader(tmp_path, monkeypatch):
+    def make(response):
+        module = sys.modules[ImageDownloader.__module__]
+        monkeypatch.setattr(module.requests, "get", lambda url, **kwargs: response)
+        registry = IngestRegistry(str(tmp_path / "registry.sqlite"))
+        return ImageDownloader("ENSG0", output_dir=str(tmp_path / "images"), registry=registry), registry
+    return make
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_failed_search_raises_and_marks_nothing(downloader, streaming):
+    images, registry = downloader(FakeResponse(503))
+    with pytest.raises(requests.HTTPError):
+        if streaming:
+            images.download_images(streaming=True)
+        else:
+            images.fetch_xml_data()
+    assert not registry.is_protein_processed("Unknown_Protein")
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_protein_without_a_name_is_not_marked_processed(downloader, streaming):
+    images, registry = downloader(FakeResponse(200, b"<proteinAtlas><entry><protein></protein></entry></proteinAtlas>"))
+    if not streaming:
+        images.fetch_xml_data()
+    assert images.download_images(streaming=streaming) is False
+    assert not registry.is_protein_processed("Unknown_Protein")
+
+
+def test_named_protein_is_marked_processed(downloader):
+    images, registry = downloader(FakeResponse(200, b"<proteinAtlas><entry><protein><name>TP53</name></protein></entry></proteinAtlas>"))
+    assert images.download_images(streaming=True) is True
+    assert registry.is_protein_processed("TP53")
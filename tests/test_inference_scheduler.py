@@ -0,0 +1,67 @@
+import threading
+import time
+import numpy as np
+import pytest
+from src.data_processing import InferenceScheduler
+
+
+class RecordingExtractor:
+    """Returns each image's value as its feature row and records the size of every forward pass."""
+
+    mode = {"backend": "eager", "precision": "fp32", "channels_last": False}
+
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.batch_sizes = []
+
+    def extract_features_batch(self, images, batch_size=None):
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("model failed")
+        self.batch_sizes.append(len(images))
+        return np.array([[image, image] for image in images], dtype=np.float32)
+
+
+def run_concurrently(scheduler, requests):
+    results = [None] * len(requests)
+
+    def call(i):
+        results[i] = scheduler.extract_features_batch(requests[i])
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_requests_share_batches_and_get_their_own_rows():
+    extractor = RecordingExtractor(delay=0.05)
+    scheduler = InferenceScheduler(extractor, max_batch_size=8, max_wait=0.05)
+    try:
+        requests = [[i * 10 + j for j in range(i % 3 + 1)] for i in range(12)]
+        results = run_concurrently(scheduler, requests)
+    finally:
+        scheduler.close()
+
+    for request, result in zip(requests, results):
+        np.testing.assert_array_equal(result[:, 0], request)
+    assert sum(extractor.batch_sizes) == sum(len(request) for request in requests)
+    assert max(extractor.batch_sizes) <= 8
+    assert len(extractor.batch_sizes) < len(requests)
+    assert scheduler.stats()["queue_depth"] == 0
+
+
+def test_a_failed_batch_fails_every_caller_in_it():
+    scheduler = InferenceScheduler(RecordingExtractor(fail=True), max_batch_size=8, max_wait=0.01)
+    try:
+        with pytest.raises(RuntimeError, match="model failed"):
+            scheduler.extract_features_batch([1, 2])
+    finally:
+        scheduler.close()
+
+
+def test_mode_is_the_wrapped_extractors():
+    assert InferenceScheduler(RecordingExtractor()).mode == RecordingExtractor.mode
@@ -0,0 +1,165 @@
+import sys
+import time
+import threading
+import numpy as np
+from src.data_processing import SuperpixelSegmenter
+from src.data_processing.DataUpdatePipeline import DataUpdatePipeline
+from src.data_processing.IngestEngine import IngestEngine
+from src.services import LocalVectorIndex
+from src.utils import IngestRegistry
+
+DIM = 128
+PARAMS = {"n_segments": 20}
+
+
+def image(seed):
+    rng = np.random.default_rng(seed)
+    rows, cols = np.mgrid[0:120, 0:160]
+    base = np.stack([(cols * 2) % 256, (rows * 3) % 256, ((rows + cols) * 2) % 256], -1)
+    return np.clip(base + rng.integers(0, 40, base.shape), 0, 255).astype(np.uint8)
+
+
+class SlowExtractor:
+    mode = "test"
+
+    def __init__(self):
+        self.active = 0
+        self.peak = 0  # Most extractions seen running at once
+        self.lock = threading.Lock()
+
+    def extract_features_batch(self, images):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.2)  # Keeps concurrent ingests of one url overlapping
+        with self.lock:
+            self.active -= 1
+        return np.stack([np.resize(np.asarray(image, dtype=np.float32).mean(axis=(0, 1)), DIM) for image in images])
+
+
+class IdentityPCA:
+    n_components = DIM
+    incremental = False
+    version = 1
+
+    def fit_transform(self, features, return_version=False):
+        return (features, self.version) if return_version else features
+
+
+def test_is_current(tmp_path):
+    registry = IngestRegistry(str(tmp_path / "registry.sqlite"))
+    content_hash = registry.content_hash(image(0))
+    assert not registry.is_current("http://x/a", content_hash, PARAMS, 1)
+
+    registry.record("http://x/a", content_hash, PARAMS, 1, 12)
+    assert registry.is_current("http://x/a", content_hash, PARAMS, 1)
+    assert registry.is_current("http://x/a", content_hash, dict(PARAMS), None)
+    assert not registry.is_current("http://x/a", registry.content_hash(image(1)), PARAMS, 1)
+    assert not registry.is_current("http://x/a", content_hash, {"n_segments": 30}, 1)
+    assert not registry.is_current("http://x/a", content_hash, PARAMS, 2)
+    assert not registry.is_current("http://x/b", content_hash, PARAMS, 1)
+
+
+def test_claims_are_exclusive_until_released_or_expired(tmp_path):
+    path = str(tmp_path / "registry.sqlite")
+    first, second = IngestRegistry(path), IngestRegistry(path)
+    assert first.claim("http://x/a", "one")
+    assert first.claim("http://x/a", "one")  # Renewing one's own claim
+    assert not second.claim("http://x/a", "two")
+    assert second.claim("http://x/b", "two")
+
+    first.release("http://x/a", "two")  # Only the owner releases
+    assert not second.claim("http://x/a", "two")
+    first.release("http://x/a", "one")
+    assert second.claim("http://x/a", "two", ttl=0.2)
+
+    assert not first.claim("http://x/a", "one")
+    assert first.claim("http://x/a", "one", wait=2, poll_interval=0.05)  # The claim of "two" expires
+
+
+def test_one_claim_wins_among_threads(tmp_path):
+    path = str(tmp_path / "registry.sqlite")
+    results = []
+    barrier = threading.Barrier(8)
+
+    def claim(owner):
+        registry = IngestRegistry(path)
+        barrier.wait()
+        results.append(registry.claim("http://x/a", owner))
+
+    threads = [threading.Thread(target=claim, args=(f"owner-{i}",)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False] * 7 + [True]
+
+
+def _pipeline(tmp_path, monkeypatch, images, segmenter=None):
+    downloads = iter(images)
+    # The package re-exports the class under the module's name, so the module is patched directly
+    module = sys.modules[DataUpdatePipeline.__module__]
+    monkeypatch.setattr(module, "download_image", lambda image_url: next(downloads))
+    index = LocalVectorIndex("c", data_dir=str(tmp_path / "index"), dim=DIM)
+    registry = IngestRegistry(str(tmp_path / "registry.sqlite"))
+    segmenter = segmenter or SuperpixelSegmenter(n_segments=20, compactness=10)
+    pipeline = DataUpdatePipeline(index, SlowExtractor(), IdentityPCA(), segmenter, registry=registry)
+    return pipeline, index, registry
+
+
+def test_reingest_replaces_stale_vectors(tmp_path, monkeypatch):
+    pipeline, index, registry = _pipeline(tmp_path, monkeypatch, [image(0), image(0), image(1)])
+    first = pipeline.update_database("http://x/a", return_details=True)
+    assert first["segments"] > 0 and len(index.ids_by_url("http://x/a")) == first["segments"]
+
+    assert pipeline.update_database("http://x/a", return_details=True)["skipped"]
+    changed = pipeline.update_database("http://x/a", return_details=True)
+    assert not changed["skipped"]
+    assert len(index.ids_by_url("http://x/a")) == changed["segments"]
+    assert registry.get("http://x/a")["content_hash"] == registry.content_hash(image(1))
+
+
+def test_concurrent_ingests_of_one_url_keep_one_set(tmp_path, monkeypatch):
+    pipeline, index, registry = _pipeline(tmp_path, monkeypatch, [image(0), image(1)])
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(pipeline.update_database("http://x/a", return_details=True)))
+               for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # The second ingest waited for the first one and then replaced its vectors
+    assert pipeline.feature_extractor.peak == 1
+    assert len(results) == 2 and not any(result["skipped"] for result in results)
+    assert len(index.ids_by_url("http://x/a")) == registry.get("http://x/a")["segment_count"]
+
+
+def test_engine_ingests_a_repeated_url_once(tmp_path, monkeypatch):
+    pipeline, index, registry = _pipeline(tmp_path, monkeypatch, [])
+    engine_module = sys.modules[IngestEngine.__module__]
+    monkeypatch.setattr(engine_module, "download_image", lambda image_url: image(0))
+    items = pipeline.update_database_many(["http://x/a", "http://x/a", "http://x/b"], segmentation_processes=0)
+
+    assert len(items) == 2 and all(item.get_attribute("primary_keys") for item in items)
+    for url in ("http://x/a", "http://x/b"):
+        assert len(index.ids_by_url(url)) == registry.get(url)["segment_count"]
+
+
+def test_engine_segments_large_images_in_tiles(tmp_path, monkeypatch):
+    def tiled():
+        return SuperpixelSegmenter(n_segments=8, compactness=10, tile_size=96, tile_overlap=16, n_jobs=1)
+
+    pipeline, index, registry = _pipeline(tmp_path, monkeypatch, [], segmenter=tiled())
+    engine_module = sys.modules[IngestEngine.__module__]
+    monkeypatch.setattr(engine_module, "download_image", lambda image_url: image(0))
+    pipeline.update_database_many(["http://x/a"], segmentation_processes=1)
+
+    # The engine stores what the tiled segmenter produces, under the parameters it used
+    segmenter = tiled()
+    try:
+        expected = segmenter.segment_and_save(image(0))
+    finally:
+        segmenter.close()
+    assert len(index.ids_by_url("http://x/a")) == len(expected)
+    assert registry.is_current("http://x/a", registry.content_hash(image(0)), pipeline.ingest_params(), None)
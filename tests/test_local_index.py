@@ -0,0 +1,86 @@
+import multiprocessing
+import numpy as np
+from src.services import LocalVectorIndex
+
+DIM = 128
+
+
+def vectors(seed, n):
+    return np.random.default_rng(seed).normal(size=(n, DIM)).astype(np.float32)
+
+
+def insert(index, seed, n, url="http://x/a"):
+    return index.insert_segments(vectors(seed, n), np.zeros((n, 2)), url)
+
+
+def _insert_in_process(data_dir, seed):
+    index = LocalVectorIndex("c", data_dir=data_dir, dim=DIM)
+    return [id for batch in range(20) for id in insert(index, seed * 100 + batch, 5, f"http://x/{seed}")]
+
+
+def test_exact_search(tmp_path):
+    index = LocalVectorIndex("c", data_dir=str(tmp_path), dim=DIM)
+    data = vectors(0, 50)
+    ids = index.insert_segments(data, np.zeros((50, 2)), "http://x/a")
+    hits = index.find_by_vectors(data[[3, 17]], top_k=2)
+    assert [hit[0][0] for hit in hits] == [ids[3], ids[17]]
+    assert hits[0][0][1] == 0.0
+
+
+def test_instances_see_each_others_writes(tmp_path):
+    search = LocalVectorIndex("c", data_dir=str(tmp_path), dim=DIM)
+    ingest = LocalVectorIndex("c", data_dir=str(tmp_path), dim=DIM)
+    first = insert(search, 0, 10)
+    second = insert(ingest, 1, 2000)  # Grows the vector file past the first mapping
+    assert second[0] == first[-1] + 1
+
+    query = vectors(1, 2000)[1500]
+    assert search.find_by_vectors([query], top_k=1)[0][0][0] == second[1500]
+
+    ingest.delete_by_ids([second[1500]])
+    assert search.find_by_vectors([query], top_k=1)[0][0][0] != second[1500]
+    assert search.find_by_id(second[1500]) is None
+
+
+def test_processes_allocate_distinct_ids(tmp_path):
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(3) as pool:
+        results = pool.starmap(_insert_in_process, [(str(tmp_path), seed) for seed in range(3)])
+    ids = [id for result in results for id in result]
+    assert sorted(ids) == list(range(300))
+
+    index = LocalVectorIndex("c", data_dir=str(tmp_path), dim=DIM)
+    for seed, result in enumerate(results):
+        assert sorted(index.ids_by_url(f"http://x/{seed}")) == sorted(result)
+        # Every process wrote its vectors at the rows of the ids it was given
+        hit = index.find_by_vectors([vectors(seed * 100 + 7, 5)[2]], top_k=1)[0][0]
+        assert hit[0] == result[7 * 5 + 2] and hit[1] < 1e-6
+
+
+def test_ivf_index_is_built_once_there_are_enough_vectors(tmp_path):
+    index = LocalVectorIndex("c", data_dir=str(tmp_path), dim=DIM, index_type="IVF_FLAT", nlist=16, nprobe=16)
+    insert(index, 0, 10)
+    assert index._centroids is None
+    ids = insert(index, 1, 200)
+    assert index._centroids is not None
+
+    # Another instance loads the saved index and assigns the rows it does not cover
+    other = LocalVectorIndex("c", data_dir=str(tmp_path), dim=DIM, index_type="IVF_FLAT", nlist=16, nprobe=16)
+    assert len(other._assignments) == 210
+    assert other.find_by_vectors([vectors(1, 200)[42]], top_k=1)[0][0][0] == ids[42]
+
+
+def test_batched_flat_search_matches_brute_force(tmp_path):
+    index = LocalVectorIndex("c", data_dir=str(tmp_path), dim=DIM, search_block_size=200)  # A few queries per block
+    data = vectors(3, 100)
+    ids = index.insert_segments(data, np.zeros((100, 2)), "http://x/a")
+    index.delete_by_ids(ids[::3])
+    queries = vectors(4, 9)
+
+    hits = index.find_by_vectors(queries, top_k=5)
+    alive = np.array([i % 3 != 0 for i in range(100)])
+    for query, matches in zip(queries, hits):
+        distances = ((data - query) ** 2).sum(axis=1)
+        distances[~alive] = np.inf
+        assert [match[0] for match in matches] == [ids[i] for i in np.argsort(distances)[:5]]
+        assert np.allclose([match[1] for match in matches], np.sort(distances)[:5], rtol=1e-4)
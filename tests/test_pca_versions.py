@@ -0,0 +1,87 @@
+import os
+import numpy as np
+from src.data_processing import PCAProcessor
+from src.data_processing.DataUpdatePipeline import DataUpdatePipeline
+from src.services import LocalVectorIndex
+from src.utils import IngestRegistry
+
+
+def features(seed, n=64, dim=16):
+    return np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+
+
+def test_processes_sharing_a_model_number_versions_from_disk(tmp_path):
+    model_path = str(tmp_path / "pca")
+    ingest = PCAProcessor(n_components=4, model_path=model_path, incremental=True, reload_interval=0)
+    other = PCAProcessor(n_components=4, model_path=model_path, incremental=True, reload_interval=0)
+
+    _, first = ingest.fit_transform(features(0), return_version=True)
+    _, second = other.fit_transform(features(1), return_version=True)
+    _, third = ingest.fit_transform(features(2), return_version=True)
+    assert (first, second, third) == (1, 2, 3)
+    # The second process continued from the first one's model instead of starting over
+    assert other.pca.n_samples_seen_ == 128
+    assert ingest.pca.n_samples_seen_ == 192
+
+
+def test_search_process_picks_up_a_newer_version(tmp_path):
+    model_path = str(tmp_path / "pca")
+    ingest = PCAProcessor(n_components=4, model_path=model_path, incremental=True)
+    ingest.fit_transform(features(0))
+    search = PCAProcessor(n_components=4, model_path=model_path, reload_interval=0)
+    assert search.version == 1
+
+    reduced, version = ingest.fit_transform(features(1), return_version=True)
+    search_reduced, search_version = search.transform(features(1), return_version=True)
+    assert search_version == version == 2
+    np.testing.assert_allclose(search_reduced, reduced, rtol=1e-5, atol=1e-5)
+
+
+def test_only_the_newest_versions_are_kept(tmp_path):
+    model_path = str(tmp_path / "pca")
+    pca = PCAProcessor(n_components=4, model_path=model_path, incremental=True, keep_versions=3)
+    for seed in range(6):
+        pca.fit_transform(features(seed))
+    assert sorted(os.listdir(model_path + ".projection")) == ["current", "v4", "v5", "v6"]
+    assert sorted(name for name in os.listdir(tmp_path) if name.startswith("pca.v")) == ["pca.v4", "pca.v5", "pca.v6"]
+
+
+def low_rank_features(seed, n=200, rank=64, dim=256):
+    rng = np.random.default_rng(seed)
+    basis = np.random.default_rng(99).normal(size=(rank, dim))
+    return (rng.normal(size=(n, rank)) * rng.uniform(0.5, 3, rank) @ basis + seed).astype(np.float32)
+
+
+def test_referenced_versions_are_not_pruned(tmp_path):
+    model_path = str(tmp_path / "pca")
+    pca = PCAProcessor(n_components=4, model_path=model_path, incremental=True, keep_versions=2,
+                       referenced_versions=lambda: [1])
+    for seed in range(4):
+        pca.fit_transform(features(seed))
+    assert sorted(os.listdir(model_path + ".projection")) == ["current", "v1", "v3", "v4"]
+
+
+def test_search_after_two_incremental_fits(tmp_path):
+    index = LocalVectorIndex("c", data_dir=str(tmp_path / "index"), dim=128)
+    registry = IngestRegistry(str(tmp_path / "registry.sqlite"))
+    pca = PCAProcessor(n_components=128, model_path=str(tmp_path / "pca"), incremental=True,
+                       referenced_versions=index.model_versions)
+    old_features, new_features = low_rank_features(0), low_rank_features(1)
+    old_vectors, old_version = pca.fit_transform(old_features, return_version=True)
+    old_ids = index.insert_segments(old_vectors, np.zeros((200, 2)), "http://x/old", model_versions=old_version)
+    new_vectors, new_version = pca.fit_transform(new_features, return_version=True)
+    index.insert_segments(new_vectors, np.zeros((200, 2)), "http://x/new", model_versions=new_version)
+    assert new_version == old_version + 1
+
+    # A query projected with the current basis is only compared with vectors of that basis
+    query = pca.transform(old_features[5:6])
+    hits = index.find_by_vectors(query, top_k=10, model_version=new_version)[0]
+    assert {segment.url for _, _, segment in hits} == {"http://x/new"}
+
+    # Once re-projected, the old image is found again in the current basis
+    pipeline = DataUpdatePipeline(index, None, pca, None, registry=registry)
+    assert pipeline.reproject_stale_vectors() == 200
+    assert index.model_versions() == [new_version]
+    segment_id, distance, segment = index.find_by_vectors(query, top_k=1, model_version=new_version)[0][0]
+    assert segment.url == "http://x/old" and distance < 1e-2
+    assert segment_id not in old_ids  # Replaced like a re-ingest
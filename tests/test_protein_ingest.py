@@ -0,0 +1,189 @@
+import json
+import asyncio
+import pytest
+from fastapi import HTTPException
+import src.services
+import src.data_processing
+from src.services import LocalVectorIndex
+from src.utils import IngestRegistry
+
+IMAGES = {"A": [f"http://a/{i}" for i in range(7)], "B": ["http://b/0", "http://b/bad", "http://b/2"]}
+
+
+class StubFeatureExtractor:
+    def __init__(self, **kwargs):
+        self.mode = {}
+
+
+@pytest.fixture(scope="module")
+def modules(tmp_path_factory):
+    """Import the worker tasks and the web app without models, Milvus or a broker."""
+    tmp = tmp_path_factory.mktemp("workers")
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(tmp)  # The workers create their caches relative to the working directory
+        patch.setattr(src.data_processing, "FeatureExtractor", StubFeatureExtractor)
+        patch.setattr(src.services, "create_vector_store", lambda backend, name, **options: LocalVectorIndex(name, data_dir=str(tmp / "index")))
+        from src.workers import tasks
+        from src import main
+    return tasks, main
+
+
+class FakeResult:
+    """An update_task result that finishes on its fourth poll."""
+
+    def __init__(self, image_url, outstanding):
+        self.image_url = image_url
+        self.outstanding = outstanding
+        self.polls = 0
+        outstanding.add(self)
+
+    def ready(self):
+        self.polls += 1
+        if self.polls >= 4:
+            self.outstanding.discard(self)
+        return self.polls >= 4
+
+    def successful(self):
+        return "bad" not in self.image_url
+
+    @property
+    def result(self):
+        if not self.successful():
+            return RuntimeError("boom")
+        return json.dumps({"status": True, "skipped": self.image_url.endswith("/0"), "segments": 3})
+
+
+@pytest.fixture
+def bulk(modules, tmp_path, monkeypatch):
+    tasks, _ = modules
+    sent, messages, peak = [], [], []
+    outstanding = set()
+
+    class FakeDownloader:
+        def __init__(self, protein, output_dir=None, registry=None):
+            self.protein = protein
+            self.protein_name = None
+
+        def iter_image_urls(self):
+            self.protein_name = self.protein
+            yield from IMAGES[self.protein]
+
+    def apply_async(args, kwargs=None, priority=None):
+        sent.append(args[0])
+        result = FakeResult(args[0], outstanding)
+        peak.append(len(outstanding))
+        return result
+
+    monkeypatch.setattr(tasks, "ImageDownloader", FakeDownloader)
+    monkeypatch.setattr(tasks.update_task, "apply_async", apply_async)
+    monkeypatch.setattr(tasks, "ingest_registry", IngestRegistry(str(tmp_path / "registry.sqlite")))
+    monkeypatch.setattr(tasks.status_publisher, "publish", messages.append)
+    monkeypatch.setattr(tasks, "bulk_ingest_poll_interval", 0)
+    monkeypatch.setattr(tasks, "bulk_ingest_progress_interval", 0)
+    return tasks, sent, messages, peak
+
+
+def test_fan_out_keeps_a_bounded_window(bulk):
+    tasks, sent, messages, peak = bulk
+    summary = json.loads(tasks.protein_ingest_task.apply(args=(["A", "B"], 3), task_id="job-1").result)
+
+    assert sorted(sent) == sorted(IMAGES["A"] + IMAGES["B"])
+    assert max(peak) == 3
+    assert summary["images_queued"] == summary["images_done"] == 10
+    assert summary["segments_inserted"] == 27 and summary["images_skipped"] == 2
+    assert summary["failures"] == 1 and summary["failed"] == ["http://b/bad"]
+    assert tasks.ingest_registry.is_protein_processed("A") and not tasks.ingest_registry.is_protein_processed("B")
+
+
+def test_repeated_protein_is_ingested_once(bulk):
+    tasks, sent, messages, peak = bulk
+    summary = json.loads(tasks.protein_ingest_task.apply(args=(["A", "A"], 3), task_id="job-4").result)
+
+    assert sorted(sent) == sorted(IMAGES["A"])
+    assert summary["proteins_total"] == summary["proteins_done"] == 1
+    assert summary["images_done"] == 7
+
+
+def test_progress_follows_images(bulk):
+    tasks, sent, messages, peak = bulk
+    tasks.protein_ingest_task.apply(args=("A", 2), task_id="job-2")
+
+    updates = [message for message in messages if message["status"] == "PROGRESS"]
+    for update in updates:
+        assert update["progress"] == round(100 * update["images_done"] / update["images_queued"], 1)
+    # A single protein advances before it is finished
+    assert any(0 < update["progress"] < 100 for update in updates)
+    assert updates[-1]["progress"] == 100
+
+
+def test_resumed_job_only_queues_unfinished_images(bulk):
+    tasks, sent, messages, peak = bulk
+    tasks.protein_ingest_task.apply(args=(["A", "B"], 4), task_id="job-3")
+    sent.clear()
+
+    # With force, the fully ingested protein A is listed again rather than skipped as processed
+    summary = json.loads(tasks.protein_ingest_task.apply(args=(["A", "B"], 4, True), task_id="job-3").result)
+    assert sent == ["http://b/bad"]
+    assert summary["images_resumed"] == 9 and summary["images_done"] == 10
+    assert summary["segments_inserted"] == 27
+
+
+def test_protein_request_validation(modules, monkeypatch):
+    _, main = modules
+    sent = []
+    monkeypatch.setattr(main.protein_ingest_task, "apply_async", lambda args, **options: sent.append((args, options)) or type("Result", (), {"id": "t"})())
+
+    for body in ({}, {"proteins": []}, {"proteins": [""]}, {"proteins": "A", "max_in_flight": "8"}, {"proteins": "A", "force": "yes"}):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(main.protein_update_endpoint(body))
+        assert error.value.status_code == 422
+    assert not sent
+
+    asyncio.run(main.protein_update_endpoint({"proteins": "A", "max_in_flight": 10000, "priority": 42, "image_priority": -1}))
+    asyncio.run(main.protein_update_endpoint({"proteins": ["A", "B", "A"]}))
+    assert sent == [
+        ((["A"], main.MAX_BULK_IN_FLIGHT, False, 0), {"priority": 9, "task_id": None}),
+        ((["A", "B"], None, False, None), {"priority": None, "task_id": None}),
+    ]
+
+
+def test_task_priorities_are_checked_and_clamped(modules, monkeypatch):
+    _, main = modules
+    sent = []
+    for task in (main.search_task, main.search_batch_task, main.update_task):
+        monkeypatch.setattr(task, "apply_async", lambda args, **options: sent.append(options["priority"]) or type("Result", (), {"id": "t"})())
+    body = {"image_url": "http://x/a", "boundary": [0, 0, 8, 8], "boundaries": [[0, 0, 8, 8]]}
+    endpoints = (main.search_endpoint, main.search_batch_endpoint, main.update_endpoint)
+
+    for endpoint in endpoints:
+        for priority in ("9", 1.5, True):
+            with pytest.raises(HTTPException) as error:
+                asyncio.run(endpoint({**body, "priority": priority}))
+            assert error.value.status_code == 422
+    assert not sent
+
+    for endpoint in endpoints:
+        for priority in (42, -3, 4, None):
+            asyncio.run(endpoint({**body, "priority": priority}))
+    assert sent == [9, 0, 4, None] * 3
+
+
+def test_search_batch_request_validation(modules, monkeypatch):
+    _, main = modules
+    sent = []
+    monkeypatch.setattr(main.search_batch_task, "apply_async", lambda args, **options: sent.append(args) or type("Result", (), {"id": "t"})())
+    body = {"image_url": "http://x/a", "boundaries": [[0, 0, 8, 8]]}
+
+    for bad in ({"boundaries": []}, {"boundaries": None}, {"boundaries": [[0, 0, 8]]}, {"boundaries": [[0, 0, 8, "8"]]},
+                {"boundaries": [[8, 0, 0, 8]]}, {"boundaries": [[0, 0, 8, 8], [0, 0, 4]]},
+                {"top_k": 0}, {"top_k": "5"}, {"top_k": 2.5}, {"top_k": True}, {"image_url": ""}):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(main.search_batch_endpoint({**body, **bad}))
+        assert error.value.status_code == 422
+    with pytest.raises(HTTPException):
+        asyncio.run(main.search_endpoint({"image_url": "http://x/a", "boundary": [0, 0, 8]}))
+    assert not sent
+
+    asyncio.run(main.search_batch_endpoint(body))
+    asyncio.run(main.search_batch_endpoint({**body, "boundaries": [[0, 0, 8, 8], [1.5, 2, 9, 9.5]], "top_k": 3}))
+    assert sent == [("http://x/a", [[0, 0, 8, 8]], 5), ("http://x/a", [[0, 0, 8, 8], [1.5, 2, 9, 9.5]], 3)]
@@ -0,0 +1,28 @@
+import numpy as np
+from src.utils import QueryCache
+
+EAGER = {"backend": "eager", "precision": "fp32", "channels_last": False}
+INT8 = {"backend": "eager", "precision": "int8-static", "channels_last": False}
+
+
+def test_inference_mode_is_part_of_the_key(tmp_path):
+    cache = QueryCache(store_path=str(tmp_path / "q.sqlite"))
+    cache.put("http://x/a", [0, 0, 8, 8], 1, np.ones(4), EAGER)
+    assert cache.get("http://x/a", [0, 0, 8, 8], 1, INT8) is None
+    np.testing.assert_array_equal(cache.get("http://x/a", [0, 0, 8, 8], 1, EAGER), np.ones(4))
+
+    # Another process sharing the store does not serve it for another mode either
+    other = QueryCache(store_path=str(tmp_path / "q.sqlite"))
+    assert other.get("http://x/a", [0, 0, 8, 8], 1, INT8) is None
+    assert other.get("http://x/a", [0, 0, 8, 8], 1, EAGER) is not None
+
+
+def test_store_is_held_to_max_entries(tmp_path):
+    cache = QueryCache(max_entries=3, store_path=str(tmp_path / "q.sqlite"))
+    for i in range(10):
+        cache.put("http://x/a", [i, i, i + 1, i + 1], 1, np.full(4, i))
+    keys = [row[0] for row in cache._connection().execute("SELECT key FROM query_vectors")]
+    assert len(keys) == 3
+    other = QueryCache(max_entries=3, store_path=str(tmp_path / "q.sqlite"))
+    assert other.get("http://x/a", [9, 9, 10, 10], 1) is not None
+    assert other.get("http://x/a", [0, 0, 1, 1], 1) is None
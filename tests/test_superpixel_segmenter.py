@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from skimage import color
+from src.data_processing import SuperpixelSegmenter
+
+
+@pytest.fixture(scope="module")
+def image():
+    rng = np.random.default_rng(0)
+    rows, cols = np.mgrid[0:300, 0:420]
+    image = np.stack([(cols // 3) % 256, (rows // 2) % 256, ((rows + cols) // 4) % 256], -1)
+    return np.clip(image + rng.integers(0, 30, image.shape), 0, 255).astype(np.uint8)
+
+
+def test_tiled_labels_cover_the_image_sequentially(image):
+    segmenter = SuperpixelSegmenter(n_segments=20, compactness=10, tile_size=160, tile_overlap=32, n_jobs=2)
+    try:
+        segmenter.image = image
+        segmenter.perform_slic_segmentation()
+    finally:
+        segmenter.close()
+    labels = np.unique(segmenter.segments)
+    assert segmenter.segments.shape == image.shape[:2]
+    assert labels[0] == 1 and labels[-1] == len(labels)
+
+
+def test_variance_matches_numpy(image):
+    segmenter = SuperpixelSegmenter(n_segments=30, compactness=10)
+    segmenter.image = image
+    segmenter.perform_slic_segmentation()
+    stats = segmenter.compute_segment_statistics(block_size=5000)
+    gray = color.rgb2gray(image)
+    for label in (1, 7, int(segmenter.segments.max())):
+        assert stats["variance"][label] == pytest.approx(np.var(gray[segmenter.segments == label]))
+
+
+def test_segments_are_cropped_whether_tiled_or_not(image):
+    for tile_size in (None, 160):
+        segmenter = SuperpixelSegmenter(n_segments=20, compactness=10, tile_size=tile_size, tile_overlap=32, n_jobs=2)
+        try:
+            segments = segmenter.segment_and_save(image)
+        finally:
+            segmenter.close()
+        for segment in segments:
+            min_row, min_col, max_row, max_col = segment["bbox"]
+            assert segment["image"].shape == (max_row - min_row, max_col - min_col, 3)